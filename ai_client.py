@@ -0,0 +1,67 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from openai import AsyncOpenAI
+
+from metrics import OPENAI_SECONDS, OPENAI_WAIT_SECONDS, OPENAI_IN_FLIGHT, observe
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_TIMEOUT,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MODEL_CONCURRENCY,
+)
+
+# Один общий клиент на процесс: keep-alive соединения переиспользуются между запросами
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_http_client)
+
+
+def _parse_model_limits(spec):
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, value = item.split("=", 1)
+        limits[model.strip()] = int(value)
+    return limits
+
+
+_global_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+_model_limits = _parse_model_limits(OPENAI_MODEL_CONCURRENCY)
+_model_slots = {}
+
+
+def _model_semaphore(model):
+    sem = _model_slots.get(model)
+    if sem is None:
+        sem = asyncio.Semaphore(_model_limits.get(model, OPENAI_MAX_CONCURRENCY))
+        _model_slots[model] = sem
+    return sem
+
+
+@asynccontextmanager
+async def model_slot(model):
+    # Сначала лимит модели, потом общий — чтобы очередь к медленной модели не занимала общие слоты
+    start = time.perf_counter()
+    async with _model_semaphore(model):
+        async with _global_slots:
+            OPENAI_WAIT_SECONDS.labels(model).observe(time.perf_counter() - start)
+            OPENAI_IN_FLIGHT.labels(model).inc()
+            try:
+                async with observe(OPENAI_SECONDS, model):
+                    yield
+            finally:
+                OPENAI_IN_FLIGHT.labels(model).dec()
+
+
+async def close():
+    await openai_client.close()
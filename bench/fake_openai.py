@@ -0,0 +1,111 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+REPLY_WORD = "ответ "
+
+
+class FakeOpenAI:
+    def __init__(self, ttft_ms=400, token_ms=10, reply_tokens=150, whisper_ms=1500, image_ms=8000,
+                 error_rate=0.0):
+        self.ttft = ttft_ms / 1000
+        self.token = token_ms / 1000
+        self.reply_tokens = reply_tokens
+        self.whisper = whisper_ms / 1000
+        self.image = image_ms / 1000
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.upload_bytes = Counter()
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_post("/v1/images/generations", self.images)
+        return app
+
+    def _error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self.calls["429"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_error", "code": "rate_limit"}},
+                status=429,
+            )
+        return None
+
+    async def chat(self, request):
+        body = await request.json()
+        model = body.get("model", "unknown")
+        self.calls[model] += 1
+        self.upload_bytes[model] += request.content_length or 0
+        error = self._error()
+        if error:
+            return error
+        tokens = min(self.reply_tokens, body.get("max_tokens") or self.reply_tokens)
+        created = int(time.time())
+        if not body.get("stream"):
+            await asyncio.sleep(self.ttft + tokens * self.token)
+            return web.json_response({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": (REPLY_WORD * tokens).strip()},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(self.ttft)
+        for i in range(tokens):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": REPLY_WORD}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.token:
+                await asyncio.sleep(self.token)
+        done = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        await response.write(f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def transcriptions(self, request):
+        self.upload_bytes["whisper-1"] += request.content_length or 0
+        await request.read()
+        self.calls["whisper-1"] += 1
+        error = self._error()
+        if error:
+            return error
+        await asyncio.sleep(self.whisper)
+        return web.Response(text="расскажи что-нибудь интересное про космос", content_type="text/plain")
+
+    async def images(self, request):
+        body = await request.json()
+        model = body.get("model", "dall-e-3")
+        self.calls[model] += 1
+        error = self._error()
+        if error:
+            return error
+        await asyncio.sleep(self.image)
+        return web.json_response({"created": int(time.time()), "data": [{"url": "https://example.invalid/bench.png"}]})
+
+    def stats(self):
+        return {"calls": dict(self.calls), "upload_bytes": dict(self.upload_bytes)}
@@ -0,0 +1,100 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+from bench import fixtures
+
+# Методы, которые считаем ответом пользователю
+CHAT_METHODS = {
+    "sendMessage", "editMessageText", "sendPhoto", "sendDocument", "sendChatAction", "deleteMessage",
+}
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms=30, error_rate=0.0, retry_after=1):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.events = defaultdict(list)
+        self.calls = Counter()
+        self._ids = itertools.count(1)
+        self._files = {}
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        return app
+
+    def file_bytes(self, file_id):
+        data = self._files.get(file_id)
+        if data is None:
+            kind, seed = file_id.split("-", 1)
+            data = fixtures.make(kind, int(seed))
+            self._files[file_id] = data
+        return data
+
+    def _message(self, chat_id, **extra):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        chat_id = data.get("chat_id")
+        if method in CHAT_METHODS and chat_id is not None:
+            if self.error_rate and random.random() < self.error_rate:
+                self.calls["429"] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+            self.events[int(chat_id)].append((time.perf_counter(), method))
+        return web.json_response({"ok": True, "result": self._result(method, data)})
+
+    def _result(self, method, data):
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(data["chat_id"], text=data.get("text", ""))
+        if method == "sendPhoto":
+            file_id = f"photo-{next(self._ids)}"
+            return self._message(data["chat_id"], photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 1024, "height": 1024},
+            ])
+        if method == "sendDocument":
+            field = data.get("document")
+            name = getattr(field, "filename", None) or "file.txt"
+            file_id = f"doc-{next(self._ids)}"
+            return self._message(data["chat_id"], document={
+                "file_id": file_id, "file_unique_id": file_id, "file_name": name,
+            })
+        if method == "getFile":
+            file_id = data["file_id"]
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.file_bytes(file_id)),
+                "file_path": file_id,
+            }
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        return True
+
+    async def handle_file(self, request):
+        self.calls["download"] += 1
+        return web.Response(body=self.file_bytes(request.match_info["path"]))
+
+    def stats(self):
+        return {"calls": dict(self.calls)}
@@ -0,0 +1,77 @@
+import io
+import os
+
+WORDS = (
+    "договор поставка оплата срок стороны ответственность цена товар качество доставка "
+    "гарантия претензия акт счет объем график условия расторжение штраф уведомление"
+).split()
+
+
+def _lines(seed, count):
+    for i in range(count):
+        yield " ".join(WORDS[(seed + i * 7 + j) % len(WORDS)] for j in range(12)) + f" {seed}-{i}"
+
+
+def make_pdf(seed, pages=30, lines_per_page=40):
+    # Минимальный PDF руками: шрифт Helvetica, ASCII-текст, чтобы не тянуть генераторы PDF
+    objects = []
+    page_ids = []
+    font_id = 3
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(None)
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for p in range(pages):
+        text = "".join(
+            f"({line.encode('ascii', 'replace').decode()}) Tj T* ".replace("?", "x")
+            for line in (f"page {p} line {i} value {seed * 31 + i}" for i in range(lines_per_page))
+        )
+        stream = f"BT /F1 10 Tf 12 TL 40 800 Td {text}ET".encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (content_id, font_id)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(page_ids)
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_xlsx(seed, rows=2000):
+    import openpyxl
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["Артикул", "Наименование", "Цена", "Остаток"])
+    for i in range(rows):
+        ws.append([f"A{seed}-{i}", WORDS[(seed + i) % len(WORDS)], (seed * 13 + i) % 1000, i % 97])
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def make_voice(seed, size=24 * 1024):
+    # Заглушка Whisper содержимое не разбирает — важен только размер загрузки
+    return b"OggS" + os.urandom(size - 4)
+
+
+def make(kind, seed):
+    if kind == "pdf":
+        return make_pdf(seed)
+    if kind == "xlsx":
+        return make_xlsx(seed)
+    if kind == "voice":
+        return make_voice(seed)
+    raise ValueError(f"Unknown fixture kind: {kind}")
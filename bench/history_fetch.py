@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import time
+
+import asyncpg
+
+import migrations
+from bench.run import DEFAULT_DATABASE_URL, percentile
+
+# Та же выборка реплик, что в load_user_state на холодном кэше истории
+FETCH = """
+SELECT role, content, created_at FROM dialog_history
+WHERE user_id = $1
+ORDER BY created_at DESC
+LIMIT $2
+"""
+
+FILL = """
+INSERT INTO dialog_history (user_id, role, content, created_at)
+SELECT
+    (random() * $2)::bigint,
+    CASE WHEN g % 2 = 0 THEN 'user' ELSE 'assistant' END,
+    md5(g::text) || md5((g + 1)::text),
+    NOW() - random() * make_interval(days => $3)
+FROM generate_series(1, $1) AS g
+"""
+
+
+async def fill(pool, rows, users, days, batch):
+    left = rows
+    while left > 0:
+        step = min(batch, left)
+        await pool.execute(FILL, step, users, days)
+        left -= step
+    await pool.execute("ANALYZE dialog_history")
+
+
+async def measure(pool, users, queries, limit):
+    latencies = []
+    async with pool.acquire() as connection:
+        statement = await connection.prepare(FETCH)
+        for _ in range(queries):
+            user_id = random.randrange(users)
+            start = time.perf_counter()
+            await statement.fetch(user_id, limit)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Задержка выборки истории диалога в зависимости от размера dialog_history")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL", DEFAULT_DATABASE_URL))
+    parser.add_argument("--sizes", default="1000000,5000000,10000000,30000000", help="размеры таблицы, строк")
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=365, help="на сколько дней назад размазать реплики")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=1000000)
+    parser.add_argument("--reset", action="store_true", help="очистить dialog_history перед заполнением")
+    args = parser.parse_args()
+
+    pool = await asyncpg.create_pool(args.database_url, min_size=1, max_size=2)
+    try:
+        await migrations.migrate(args.database_url)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with pool.acquire() as connection:
+            await migrations.ensure_partitions(
+                connection, now - datetime.timedelta(days=args.days + 31), migrations.next_month(now)
+            )
+        if args.reset:
+            await pool.execute("TRUNCATE dialog_history")
+
+        current = await pool.fetchval("SELECT COUNT(*) FROM dialog_history")
+        print(f"{'rows':>12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+        for size in sorted(int(s) for s in args.sizes.split(",")):
+            if size > current:
+                await fill(pool, size - current, args.users, args.days, args.batch)
+                current = size
+            latencies = await measure(pool, args.users, args.queries, args.limit)
+            ms = [v * 1000 for v in latencies]
+            print(
+                f"{current:>12} {percentile(ms, 50):>8.3f} {percentile(ms, 95):>8.3f} "
+                f"{percentile(ms, 99):>8.3f} {statistics.mean(ms):>8.3f}"
+            )
+
+        plan = await pool.fetch("EXPLAIN (ANALYZE, BUFFERS) " + FETCH, random.randrange(args.users), args.limit)
+        print("\n" + "\n".join(row[0] for row in plan))
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Что main.py импортировал при старте до реестра извлекателей
+EAGER_BACKENDS = [
+    "pandas", "textract", "openpyxl", "xlrd", "pptx", "docx", "PyPDF2", "rarfile", "pydub",
+]
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+failed = []
+for name in sys.argv[1:]:
+    try:
+        __import__(name)
+    except Exception as e:
+        failed.append(f"{name}: {e.__class__.__name__}")
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "seconds": round(elapsed, 3),
+    "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "failed": failed,
+}))
+"""
+
+
+def measure(modules, runs):
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE, *modules], cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        results.append(json.loads(out.stdout))
+    best = min(results, key=lambda r: r["seconds"])
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта и RSS: бэкенды документов eagerly против реестра")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    # Общая часть (aiogram, openai, fastapi...) одинакова в обоих вариантах, сравниваем разницу
+    common = ["aiogram", "openai", "asyncpg", "fastapi", "httpx"]
+    rows = {
+        "common": measure(common, args.runs),
+        "eager": measure(common + ["extractors"] + EAGER_BACKENDS, args.runs),
+        "lazy": measure(common + ["extractors"], args.runs),
+    }
+    for name, row in rows.items():
+        failed = f"  (не установлены: {', '.join(row['failed'])})" if row["failed"] else ""
+        print(f"{name:<7} {row['seconds']:>7.3f} s  {row['max_rss_mb']:>7.1f} MB{failed}")
+    print(
+        f"\nэкономия на старте: {rows['eager']['seconds'] - rows['lazy']['seconds']:.3f} s, "
+        f"{rows['eager']['max_rss_mb'] - rows['lazy']['max_rss_mb']:.1f} MB RSS"
+    )
+
+
+if __name__ == "__main__":
+    main()
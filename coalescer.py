@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import logging
+
+_turn = contextvars.ContextVar("coalesced_turn", default=None)
+
+
+def record():
+    # Реплика пользователя записана в историю — при отмене её не нужно нести в следующий ход
+    turn = _turn.get()
+    if turn is not None:
+        turn.recorded = True
+
+
+def charged():
+    # За ход списан запрос из квоты — если его отменят, следующий ход повторно не платит
+    turn = _turn.get()
+    if turn is not None:
+        turn.paid = True
+
+
+def paid():
+    turn = _turn.get()
+    return turn is not None and turn.paid
+
+
+def settle():
+    # Ответ готов и уже отправляется — новые сообщения его больше не отменяют
+    turn = _turn.get()
+    if turn is not None:
+        turn.settled = True
+
+
+class _Turn:
+    __slots__ = ("parts", "recorded", "settled", "paid")
+
+    def __init__(self, parts, paid):
+        self.parts = parts
+        self.recorded = False
+        self.settled = False
+        self.paid = paid
+
+
+class _Pending:
+    __slots__ = ("messages", "parts", "timer", "deadline", "paid")
+
+    def __init__(self, deadline):
+        self.messages = []
+        self.parts = []
+        self.timer = None
+        self.deadline = deadline
+        self.paid = False
+
+
+class Coalescer:
+    # Несколько сообщений подряд от одного пользователя — один ход диалога.
+    # Тексты копятся, пока пауза не превысит window (но не дольше max_wait с первого),
+    # и уходят в handler(message, text) фоновой задачей. Если пользователь дописал что-то,
+    # пока модель ещё отвечает, тот ответ отменяется: новый ход увидит оба куска
+    # (из истории или, если реплика туда не успела, склеенными с новым текстом).
+    # Оплата отменённого хода тоже переносится: за пачку сообщений — один ответ и одно списание.
+    def __init__(self, handler, window, max_wait):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self._pending = {}
+        self._running = {}
+        self._tasks = set()
+
+    def add(self, message, text, paid=False, alone=False):
+        # paid — запрос за этот кусок уже списан (например, за распознавание голосового);
+        # alone — команда, которую распознают по началу текста: её не склеиваем с соседними сообщениями
+        key = (message.chat.id, message.from_user.id)
+        if alone:
+            # Накопленное уходит сразу, а сама команда — отдельным ходом. Команда — граница пачек:
+            # ни её, ни ходы до неё следующие сообщения не отменяют и к себе не присоединяют
+            if key in self._pending:
+                self._flush(key)
+            self._running.pop(key, None)
+            self._spawn(key, _Turn([text], paid), message, text)
+            return
+        carried = []
+        paid_before = False
+        running = self._running.get(key)
+        if running is not None and not running[1].settled:
+            task, turn = self._running.pop(key)
+            task.cancel()
+            if not turn.recorded:
+                carried = turn.parts
+            paid_before = turn.paid
+        loop = asyncio.get_running_loop()
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _Pending(loop.time() + self.max_wait)
+        else:
+            pending.timer.cancel()
+        pending.parts[:0] = carried
+        pending.paid = pending.paid or paid_before or paid
+        pending.messages.append(message)
+        pending.parts.append(text)
+        delay = min(self.window, max(0.0, pending.deadline - loop.time()))
+        pending.timer = loop.call_later(delay, self._flush, key)
+
+    def _flush(self, key):
+        pending = self._pending.pop(key)
+        pending.timer.cancel()
+        # Отвечаем на последнее сообщение пачки
+        message = pending.messages[-1]
+        turn = _Turn(pending.parts, pending.paid)
+        task = self._spawn(key, turn, message, "\n".join(pending.parts))
+        self._running[key] = (task, turn)
+
+    def _spawn(self, key, turn, message, text):
+        task = asyncio.create_task(self._run(key, turn, message, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, key, turn, message, text):
+        _turn.set(turn)
+        try:
+            await self.handler(message, text)
+        except asyncio.CancelledError:
+            logging.info("Reply for chat %s superseded by newer messages", key[0])
+        except Exception:
+            logging.exception("Coalesced turn failed for chat %s", key[0])
+        finally:
+            if self._running.get(key, (None,))[0] is asyncio.current_task():
+                del self._running[key]
+
+    async def stop(self, timeout=30):
+        for key in list(self._pending):
+            self._flush(key)
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -9,3 +9,123 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID"))
 DATABASE_URL = os.getenv("DATABASE_URL")
 SERPAPI_KEY = os.getenv("SERPAPI_KEY")
+
+# Пул соединений с Postgres (statement cache 0 — для PgBouncer в transaction-режиме)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+
+# OpenAI: пул соединений и ограничения параллелизма
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+# Формат: "gpt-4o=48,whisper-1=16,dall-e-3=4"
+OPENAI_MODEL_CONCURRENCY = os.getenv("OPENAI_MODEL_CONCURRENCY", "gpt-4o=48,whisper-1=16,dall-e-3=4")
+
+# Очередь входящих апдейтов вебхука
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "2000"))
+UPDATE_QUEUE_PER_CHAT = int(os.getenv("UPDATE_QUEUE_PER_CHAT", "20"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+
+# Потоковые ответы GPT-4o
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+STREAM_MIN_DELTA = int(os.getenv("STREAM_MIN_DELTA", "40"))
+
+# Кэш истории диалогов (write-behind)
+HISTORY_CACHE_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "32"))
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "10000"))
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "3600"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "200"))
+HISTORY_PENDING_MAX_BYTES = int(os.getenv("HISTORY_PENDING_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Контекст диалога: бюджет токенов и сжатие старых реплик в резюме
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "16"))
+CONTEXT_FOLD_MIN_TURNS = int(os.getenv("CONTEXT_FOLD_MIN_TURNS", "4"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "500"))
+
+# Извлечение текста из документов (пул процессов)
+DOC_WORKERS = int(os.getenv("DOC_WORKERS", "2"))
+DOC_JOB_TIMEOUT = float(os.getenv("DOC_JOB_TIMEOUT", "20"))
+DOC_WORKER_MEMORY_MB = int(os.getenv("DOC_WORKER_MEMORY_MB", "512"))
+DOC_WORKER_MAX_TASKS = int(os.getenv("DOC_WORKER_MAX_TASKS", "50"))
+# Бэкенды, которые импортировать в воркерах при старте: "all" или "PyPDF2,openpyxl"
+EXTRACTORS_WARMUP = os.getenv("EXTRACTORS_WARMUP", "")
+DOC_MAX_CHARS = int(os.getenv("DOC_MAX_CHARS", "200000"))
+
+# Резюме длинных документов (map-reduce)
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", "3000"))
+DOC_MAX_CHUNKS = int(os.getenv("DOC_MAX_CHUNKS", "40"))
+DOC_FANOUT = int(os.getenv("DOC_FANOUT", "4"))
+DOC_SUMMARY_CONCURRENCY = int(os.getenv("DOC_SUMMARY_CONCURRENCY", "12"))
+
+# Кэш результатов по содержимому файлов
+FILE_CACHE_MAX_BYTES = int(os.getenv("FILE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+FILE_CACHE_DB = os.getenv("FILE_CACHE_DB", "0") == "1"
+
+# Голосовые: длинные записи режем по паузам и распознаём параллельно
+VOICE_CHUNK_SECONDS = int(os.getenv("VOICE_CHUNK_SECONDS", "120"))
+VOICE_MAX_PARALLEL = int(os.getenv("VOICE_MAX_PARALLEL", "4"))
+
+# Склейка сообщений подряд в один ход: пауза, после которой отвечаем, и максимум ожидания
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.2"))
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", "4"))
+
+# Фото: сколько ждать остальные снимки альбома и качество JPEG при пережатии
+VISION_ALBUM_WINDOW = float(os.getenv("VISION_ALBUM_WINDOW", "1.5"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Скачивание документов и разбор архивов
+DOC_MAX_BYTES = int(os.getenv("DOC_MAX_BYTES", str(20 * 1024 * 1024)))
+DOC_SPOOL_BYTES = int(os.getenv("DOC_SPOOL_BYTES", str(1024 * 1024)))
+ARCHIVE_MAX_DEPTH = int(os.getenv("ARCHIVE_MAX_DEPTH", "2"))
+ARCHIVE_MAX_RATIO = int(os.getenv("ARCHIVE_MAX_RATIO", "100"))
+ARCHIVE_MAX_TOTAL_BYTES = int(os.getenv("ARCHIVE_MAX_TOTAL_BYTES", str(64 * 1024 * 1024)))
+ARCHIVE_MAX_MEMBERS = int(os.getenv("ARCHIVE_MAX_MEMBERS", "500"))
+
+# Генерация картинок: фоновые задания и кэш готовых изображений
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "4"))
+IMAGE_MAX_QUEUED = int(os.getenv("IMAGE_MAX_QUEUED", "50"))
+IMAGE_PER_USER = int(os.getenv("IMAGE_PER_USER", "2"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "1000"))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Дневные лимиты запросов (0 — без ограничений)
+FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "30"))
+PAID_DAILY_LIMIT = int(os.getenv("PAID_DAILY_LIMIT", "0"))
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+
+# Кэш статуса подписки
+ENTITLEMENT_TTL = int(os.getenv("ENTITLEMENT_TTL", "300"))
+ENTITLEMENT_CACHE_USERS = int(os.getenv("ENTITLEMENT_CACHE_USERS", "50000"))
+
+# Статистика для админа
+STATS_REFRESH_INTERVAL = int(os.getenv("STATS_REFRESH_INTERVAL", "600"))
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "60"))
+
+# Секции dialog_history и срок хранения (0 — хранить всё)
+HISTORY_PARTITION_MONTHS_AHEAD = int(os.getenv("HISTORY_PARTITION_MONTHS_AHEAD", "2"))
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_ARCHIVE = os.getenv("HISTORY_ARCHIVE", "0") == "1"
+HISTORY_MAINTENANCE_INTERVAL = int(os.getenv("HISTORY_MAINTENANCE_INTERVAL", str(6 * 3600)))
+
+# Исходящие запросы к Bot API: лимиты в сообщениях в секунду, повторы после 429
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "28"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_BULK_RATE = float(os.getenv("SEND_BULK_RATE", "20"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Рассылка владельца
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
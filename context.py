@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+from ai_client import openai_client, model_slot
+from history_cache import as_utc
+from tokens import count_tokens, message_tokens
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткую память о диалоге пользователя с ассистентом. "
+    "Обнови резюме: добавь к нему важные факты, просьбы, решения и контекст из новых реплик. "
+    "Пиши сжато, по-русски, без вступлений, не более 15 пунктов."
+)
+
+
+class ContextBuilder:
+    # Собирает промпт под бюджет токенов; старые реплики сворачиваются в резюме в фоне
+    def __init__(self, db, history, budget, max_turns, fold_min_turns, summary_model,
+                 summary_max_tokens, max_users):
+        self.db = db
+        self.history = history
+        self.budget = budget
+        self.max_turns = max_turns
+        self.fold_min_turns = fold_min_turns
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.max_users = max_users
+        self._summaries = OrderedDict()
+        self._jobs = {}
+
+    async def build(self, user_id):
+        summary, until = await self._get_summary(user_id)
+        turns = await self.history.get_turns(user_id)
+        if until is not None:
+            turns = [t for t in turns if t[2] > until]
+
+        budget = self.budget
+        if summary:
+            budget -= message_tokens("system", summary)
+        kept = []
+        used = 0
+        for role, content, created_at in reversed(turns):
+            cost = message_tokens(role, content)
+            # Последняя реплика идёт в контекст всегда, даже если сама не влезает
+            if kept and (used + cost > budget or len(kept) >= self.max_turns):
+                break
+            kept.append((role, content, created_at))
+            used += cost
+        kept.reverse()
+
+        overflow = turns[:len(turns) - len(kept)]
+        if len(overflow) >= self.fold_min_turns and user_id not in self._jobs:
+            self._jobs[user_id] = asyncio.create_task(self._fold(user_id, summary, overflow))
+
+        messages = []
+        if summary:
+            messages.append({
+                "role": "system",
+                "content": f"Краткое содержание предыдущей части разговора:\n{summary}",
+            })
+        messages.extend({"role": role, "content": content} for role, content, _ in kept)
+        return messages
+
+    async def _get_summary(self, user_id):
+        cached = self._summaries.get(user_id)
+        if cached is None:
+            row = await self.db.get_summary(user_id)
+            cached = (row["summary"], as_utc(row["summarized_until"])) if row else (None, None)
+            self._remember(user_id, cached)
+        else:
+            self._summaries.move_to_end(user_id)
+        return cached
+
+    def loaded(self, user_id):
+        return user_id in self._summaries
+
+    def seed(self, user_id, summary, summarized_until):
+        if user_id not in self._summaries:
+            self._remember(user_id, (summary, as_utc(summarized_until)))
+
+    def _remember(self, user_id, value):
+        self._summaries[user_id] = value
+        self._summaries.move_to_end(user_id)
+        while len(self._summaries) > self.max_users:
+            self._summaries.popitem(last=False)
+
+    async def _fold(self, user_id, summary, turns):
+        try:
+            # Сворачиваем с самых старых, порциями под бюджет: каждая порция обновляет резюме,
+            # а отметка until сдвигается ровно до последней реплики, реально попавшей в резюме
+            while turns:
+                chunk = self._fold_chunk(turns)
+                summary = await self._summarize(summary, chunk)
+                until = chunk[-1][2]
+                await self.db.save_summary(user_id, summary, until)
+                self._remember(user_id, (summary, until))
+                turns = turns[len(chunk):]
+        except Exception:
+            logging.exception("Failed to fold dialog history for user %s", user_id)
+        finally:
+            self._jobs.pop(user_id, None)
+
+    def _fold_chunk(self, turns):
+        chunk = []
+        used = 0
+        for turn in turns:
+            cost = count_tokens(self._line(turn))
+            if chunk and used + cost > self.budget:
+                break
+            chunk.append(turn)
+            used += cost
+        return chunk
+
+    @staticmethod
+    def _line(turn):
+        role, content, _ = turn
+        return f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}"
+
+    async def _summarize(self, summary, turns):
+        dialog = "\n".join(self._line(turn) for turn in turns)
+        # Одна огромная вставка сама не влезает в бюджет — для памяти о диалоге хватит её начала
+        if count_tokens(dialog) > self.budget:
+            dialog = dialog[:self.budget * 3]
+        async with model_slot(self.summary_model):
+            response = await openai_client.chat.completions.create(
+                model=self.summary_model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Текущее резюме:\n{summary or '—'}\n\nНовые реплики:\n{dialog}"},
+                ],
+                max_tokens=self.summary_max_tokens,
+                temperature=0.2,
+            )
+        return response.choices[0].message.content.strip()
+
+    async def stop(self):
+        jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
@@ -1,35 +1,230 @@
+import time
+from contextlib import asynccontextmanager
+
 import asyncpg
 
+import metrics
+
+# Срок подписки в днях по тарифу
+PLAN_DAYS = {"monthly": 30, "yearly": 365}
+
+
 class Database:
-    def __init__(self, dsn):
+    def __init__(self, dsn, min_size=2, max_size=10, statement_cache_size=256, command_timeout=None):
         self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.command_timeout = command_timeout
         self.pool = None
+        # Вызываются с user_id после изменения подписки (сброс кэшей)
+        self.subscription_listeners = []
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(self.dsn)
+        # Все запросы — постоянный текст с параметрами, поэтому asyncpg готовит каждый один раз
+        # на соединение и дальше шлёт только Bind/Execute
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            command_timeout=self.command_timeout,
+        )
+
+    async def disconnect(self):
+        if self.pool:
+            await self.pool.close()
+
+    @asynccontextmanager
+    async def acquire(self, query):
+        start = time.perf_counter()
+        async with self.pool.acquire() as connection:
+            metrics.DB_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+            async with metrics.observe(metrics.DB_QUERY_SECONDS, query):
+                yield connection
 
     async def add_user(self, user_id):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO users (user_id, requests_today) VALUES ($1, 0)
-                ON CONFLICT (user_id) DO NOTHING
-            ''', user_id)
-
-    async def increment_request(self, user_id):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE users SET requests_today = requests_today + 1 WHERE user_id = $1
-            ''', user_id)
-
-    async def get_requests_today(self, user_id):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT requests_today FROM users WHERE user_id = $1
-            ''', user_id)
-            return row['requests_today'] if row else 0
-
-    async def reset_all_requests(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE users SET requests_today = 0
-            ''')
+        # True, если пользователь новый
+        async with self.acquire("add_user") as connection:
+            status = await connection.execute(
+                "INSERT INTO users (user_id, requests_today) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
+                user_id, 0
+            )
+            return status.endswith(" 1")
+
+    async def get_user_ids(self, after, limit):
+        # Постранично по первичному ключу: каждая страница — короткий index scan, без OFFSET
+        async with self.acquire("get_user_ids") as connection:
+            rows = await connection.fetch(
+                "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                after, limit
+            )
+            return [row["user_id"] for row in rows]
+
+    async def get_request_counter(self, user_id):
+        async with self.acquire("get_request_counter") as connection:
+            return await connection.fetchrow(
+                "SELECT requests_today, requests_date FROM users WHERE user_id = $1",
+                user_id
+            )
+
+    async def add_request_counts(self, rows):
+        # rows: (user_id, delta, date); счётчик за другой день перезаписывается, а не суммируется
+        async with self.acquire("add_request_counts") as connection:
+            await connection.executemany(
+                """
+                INSERT INTO users (user_id, requests_today, requests_date) VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    requests_today = CASE
+                        WHEN users.requests_date = EXCLUDED.requests_date
+                        THEN users.requests_today + EXCLUDED.requests_today
+                        ELSE EXCLUDED.requests_today
+                    END,
+                    requests_date = EXCLUDED.requests_date
+                """,
+                rows
+            )
+
+    async def load_user_state(self, user_id, limit):
+        # Всё, что нужно на холодном пути сообщения, за один запрос: заводит пользователя,
+        # возвращает счётчик, подписку, резюме и последние реплики (функция из миграции 4)
+        async with self.acquire("load_user_state") as connection:
+            return await connection.fetchrow("SELECT * FROM load_user_state($1, $2)", user_id, limit)
+
+    async def fetch_turns(self, user_id, limit=16):
+        async with self.acquire("fetch_turns") as connection:
+            rows = await connection.fetch(
+                """
+                SELECT role, content, created_at FROM dialog_history
+                WHERE user_id = $1
+                ORDER BY created_at DESC
+                LIMIT $2
+                """,
+                user_id, limit
+            )
+            return list(reversed(rows))
+
+    async def add_messages(self, rows):
+        # rows: (user_id, role, content, created_at); COPY дешевле пачки INSERT
+        async with self.acquire("add_messages") as connection:
+            await connection.copy_records_to_table(
+                "dialog_history",
+                records=rows,
+                columns=["user_id", "role", "content", "created_at"],
+            )
+
+    async def get_cached_file(self, kind, file_unique_id, content_hash):
+        async with self.acquire("get_cached_file") as connection:
+            row = await connection.fetchrow(
+                """
+                SELECT c.value, c.content_hash FROM file_cache c
+                WHERE c.kind = $1 AND c.content_hash = COALESCE(
+                    $3, (SELECT a.content_hash FROM file_cache_alias a WHERE a.file_unique_id = $2)
+                )
+                """,
+                kind, file_unique_id, content_hash
+            )
+            return (row["value"], row["content_hash"]) if row else (None, None)
+
+    async def put_cached_file(self, kind, file_unique_id, content_hash, value):
+        async with self.acquire("put_cached_file") as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    """
+                    INSERT INTO file_cache (content_hash, kind, value) VALUES ($1, $2, $3)
+                    ON CONFLICT (content_hash, kind) DO UPDATE SET value = EXCLUDED.value
+                    """,
+                    content_hash, kind, value
+                )
+                if file_unique_id is not None:
+                    await connection.execute(
+                        """
+                        INSERT INTO file_cache_alias (file_unique_id, content_hash) VALUES ($1, $2)
+                        ON CONFLICT (file_unique_id) DO UPDATE SET content_hash = EXCLUDED.content_hash
+                        """,
+                        file_unique_id, content_hash
+                    )
+
+    async def get_summary(self, user_id):
+        async with self.acquire("get_summary") as connection:
+            return await connection.fetchrow(
+                "SELECT summary, summarized_until FROM dialog_summary WHERE user_id = $1",
+                user_id
+            )
+
+    async def save_summary(self, user_id, summary, summarized_until):
+        async with self.acquire("save_summary") as connection:
+            await connection.execute(
+                """
+                INSERT INTO dialog_summary (user_id, summary, summarized_until) VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE
+                SET summary = EXCLUDED.summary, summarized_until = EXCLUDED.summarized_until, updated_at = NOW()
+                """,
+                user_id, summary, summarized_until
+            )
+
+    async def add_subscription(self, user_id, plan, payment_id):
+        days = PLAN_DAYS.get(plan)
+        if days is None:
+            raise ValueError("Unknown plan type")
+        async with self.acquire("add_subscription") as connection:
+            await connection.execute(
+                """
+                INSERT INTO subscriptions
+                    (user_id, plan, started_at, expires_at, payment_id, status)
+                VALUES
+                    ($1, $2, NOW(), NOW() + make_interval(days => $3), $4, 'active')
+                """,
+                user_id, plan, days, payment_id
+            )
+        for listener in self.subscription_listeners:
+            listener(user_id, plan)
+
+    async def get_user_subscription(self, user_id):
+        async with self.acquire("get_user_subscription") as connection:
+            row = await connection.fetchrow(
+                """
+                SELECT plan, expires_at FROM subscriptions
+                WHERE user_id = $1 AND status = 'active' AND expires_at > NOW()
+                ORDER BY expires_at DESC
+                LIMIT 1
+                """,
+                user_id
+            )
+            return row
+
+    async def get_stats(self):
+        # Полный пересчёт одним запросом; вызывается редко, из фоновой задачи Stats
+        async with self.acquire("get_stats") as connection:
+            rows = await connection.fetch(
+                """
+                SELECT NULL AS plan, COUNT(*) AS n FROM users
+                UNION ALL
+                SELECT plan, COUNT(*) FROM subscriptions
+                WHERE status = 'active' AND expires_at > NOW()
+                GROUP BY plan
+                """
+            )
+            users = next(row["n"] for row in rows if row["plan"] is None)
+            plans = {row["plan"]: row["n"] for row in rows if row["plan"] is not None}
+            return users, plans
+
+    async def add_daily_stats(self, rows):
+        # rows: (day, active_users, messages); сообщения суммируются, активные — максимум из процессов
+        async with self.acquire("add_daily_stats") as connection:
+            await connection.executemany(
+                """
+                INSERT INTO daily_stats (day, active_users, messages) VALUES ($1, $2, $3)
+                ON CONFLICT (day) DO UPDATE SET
+                    active_users = GREATEST(daily_stats.active_users, EXCLUDED.active_users),
+                    messages = daily_stats.messages + EXCLUDED.messages
+                """,
+                rows
+            )
+
+    async def get_daily_stats(self, days):
+        async with self.acquire("get_daily_stats") as connection:
+            return await connection.fetch(
+                "SELECT day, active_users, messages FROM daily_stats ORDER BY day DESC LIMIT $1",
+                days
+            )
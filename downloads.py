@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+from io import BytesIO
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class CappedBuffer:
+    # Приёмник для bot.download_file: держит файл в памяти до порога, дальше — во временном файле.
+    # Размер ограничен сверху, хэш содержимого считается по ходу записи.
+    def __init__(self, max_bytes, spool_bytes):
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._memory = BytesIO()
+        self._file = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise FileTooLarge()
+        self._hash.update(chunk)
+        if self._file is None and self.size > self.spool_bytes:
+            self._file = tempfile.NamedTemporaryFile(prefix="doc_", delete=False)
+            self._file.write(self._memory.getvalue())
+            self._memory = None
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._memory.write(chunk)
+        return len(chunk)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def seek(self, *args):
+        # aiogram перематывает приёмник после скачивания; читаем мы через source()
+        return 0
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def source(self):
+        # Мелкие файлы уходят в воркер байтами, крупные — путём, без копии через pickle
+        if self._file is not None:
+            self._file.flush()
+            return self._file.name
+        return self._memory.getvalue()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._file.name)
+            except OSError:
+                pass
+            self._file = None
+        self._memory = None
+
+
+async def download(bot, file_id, max_bytes, spool_bytes):
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > max_bytes:
+        raise FileTooLarge()
+    buffer = CappedBuffer(max_bytes, spool_bytes)
+    try:
+        await bot.download_file(file.file_path, destination=buffer)
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
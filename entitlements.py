@@ -0,0 +1,38 @@
+import datetime
+import time
+from collections import OrderedDict
+
+
+class EntitlementCache:
+    # Активная подписка пользователя (или её отсутствие) с TTL, но не дольше expires_at
+    def __init__(self, db, ttl, max_users):
+        self.db = db
+        self.ttl = ttl
+        self.max_users = max_users
+        self._items = OrderedDict()
+
+    async def get(self, user_id):
+        item = self._items.get(user_id)
+        if item is not None and time.monotonic() < item[1]:
+            self._items.move_to_end(user_id)
+            return item[0]
+        sub = await self.db.get_user_subscription(user_id)
+        self.seed(user_id, sub)
+        return sub
+
+    def loaded(self, user_id):
+        item = self._items.get(user_id)
+        return item is not None and time.monotonic() < item[1]
+
+    def seed(self, user_id, sub):
+        ttl = self.ttl
+        if sub is not None:
+            left = (sub["expires_at"] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            ttl = max(0, min(ttl, left))
+        self._items[user_id] = (sub, time.monotonic() + ttl)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_users:
+            self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._items.pop(user_id, None)
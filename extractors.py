@@ -0,0 +1,341 @@
+import asyncio
+import codecs
+import csv
+import importlib
+import io
+import logging
+import multiprocessing
+import resource
+import signal
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+class ExtractionContext:
+    # Состояние одного задания: лимиты на архивы общие для всех уровней вложенности
+    def __init__(self, max_depth=2, max_ratio=100, max_total_bytes=64 * 1024 * 1024, max_members=500):
+        self.max_depth = max_depth
+        self.max_ratio = max_ratio
+        self.max_total_bytes = max_total_bytes
+        self.max_members = max_members
+        self.depth = 0
+        self.total_bytes = 0
+        self.members = 0
+        self.stopped = False
+
+
+# ------- Реестр извлекателей --------
+# Бэкенды (PyPDF2, python-docx, openpyxl...) импортируются внутри извлекателя при первом вызове,
+# поэтому процесс бота их не грузит вовсе, а воркер пула — только то, что реально понадобилось.
+_BY_EXTENSION = {}
+_BY_MIME = {}
+_BACKENDS = {}
+
+
+def register(extensions, mime_types=(), backends=()):
+    def decorator(func):
+        for ext in extensions:
+            _BY_EXTENSION[ext] = func
+        for mime in mime_types:
+            _BY_MIME[mime] = func
+        _BACKENDS[func.__name__] = backends
+        return func
+    return decorator
+
+
+def get_extractor(filename, mime_type=None, fallback=True):
+    # Сначала по самому длинному совпавшему расширению, потом по MIME, иначе textract
+    matches = [ext for ext in _BY_EXTENSION if filename.endswith(ext)]
+    if matches:
+        return _BY_EXTENSION[max(matches, key=len)]
+    if mime_type in _BY_MIME:
+        return _BY_MIME[mime_type]
+    return iter_textract if fallback else None
+
+
+def backends():
+    return sorted({module for modules in _BACKENDS.values() for module in modules})
+
+
+def warm_up(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            logging.warning("Extractor backend %s is not installed", module)
+    return len(modules)
+
+
+# ------- Потоковые извлекатели: отдают текст частями, пока его не хватит --------
+@register([".pdf"], ["application/pdf"], backends=["PyPDF2"])
+def iter_pdf(f, filename, ctx):
+    from PyPDF2 import PdfReader
+    for page in PdfReader(f).pages:
+        yield page.extract_text() or ""
+
+
+@register(
+    [".docx"],
+    ["application/vnd.openxmlformats-officedocument.wordprocessingml.document"],
+    backends=["docx"],
+)
+def iter_docx(f, filename, ctx):
+    from docx import Document as DocxDocument
+    for p in DocxDocument(f).paragraphs:
+        yield p.text + "\n"
+
+
+@register([".txt", ".md", ".log", ".json"], ["text/plain", "text/markdown", "application/json"])
+def iter_txt(f, filename, ctx):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    while True:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            break
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+@register([".csv"], ["text/csv"])
+def iter_csv(f, filename, ctx):
+    reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8", errors="ignore", newline=""))
+    for row in reader:
+        yield ",".join(row) + "\n"
+
+
+@register(
+    [".xlsx"],
+    ["application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"],
+    backends=["openpyxl"],
+)
+def iter_xlsx(f, filename, ctx):
+    import openpyxl
+    wb = openpyxl.load_workbook(f, read_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield "\t".join([str(cell) for cell in row if cell is not None]) + "\n"
+    finally:
+        wb.close()
+
+
+@register([".xls"], ["application/vnd.ms-excel"], backends=["xlrd"])
+def iter_xls(f, filename, ctx):
+    import xlrd
+    book = xlrd.open_workbook(file_contents=f.read(), on_demand=True)
+    sheet = book.sheet_by_index(0)
+    for rx in range(sheet.nrows):
+        yield "\t".join([str(cell) for cell in sheet.row_values(rx)]) + "\n"
+
+
+@register(
+    [".pptx"],
+    ["application/vnd.openxmlformats-officedocument.presentationml.presentation"],
+    backends=["pptx"],
+)
+def iter_pptx(f, filename, ctx):
+    import pptx
+    for slide in pptx.Presentation(f).slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                yield shape.text + "\n"
+
+
+@register([".zip"], ["application/zip"])
+def iter_zip(f, filename, ctx):
+    with zipfile.ZipFile(f) as archive:
+        yield f"ZIP-архив {filename}, содержит:\n"
+        for info in archive.infolist():
+            if not info.is_dir():
+                yield from _iter_member(
+                    info.filename, info.file_size, info.compress_size, lambda: archive.open(info), ctx
+                )
+            if ctx.stopped:
+                break
+
+
+@register([".rar"], ["application/vnd.rar", "application/x-rar-compressed"], backends=["rarfile"])
+def iter_rar(f, filename, ctx):
+    import rarfile
+    with rarfile.RarFile(f) as archive:
+        yield f"RAR-архив {filename}, содержит:\n"
+        for info in archive.infolist():
+            if not info.is_dir():
+                yield from _iter_member(
+                    info.filename, info.file_size, info.compress_size, lambda: archive.open(info), ctx
+                )
+            if ctx.stopped:
+                break
+
+
+ARCHIVES = (iter_zip, iter_rar)
+
+
+def _iter_member(name, size, compressed, opener, ctx):
+    # Файлы архива разбираем по одному; всё подозрительное только перечисляем
+    ctx.members += 1
+    if ctx.members > ctx.max_members:
+        ctx.stopped = True
+        yield "… в архиве слишком много файлов, остальные пропущены\n"
+        return
+    extractor = get_extractor(name.lower(), fallback=None)
+    if extractor is None:
+        yield f"{name}\n"
+        return
+    if extractor in ARCHIVES and ctx.depth >= ctx.max_depth:
+        yield f"{name} (вложенный архив, не раскрыт)\n"
+        return
+    if compressed and size / compressed > ctx.max_ratio:
+        yield f"{name} (пропущен: подозрительно сильное сжатие)\n"
+        return
+    if ctx.total_bytes + size > ctx.max_total_bytes:
+        ctx.stopped = True
+        yield f"{name} (пропущен: превышен лимит распаковки)\n"
+        return
+
+    # Заголовкам архива не верим: читаем не больше заявленного размера + 1 байт.
+    # Зашифрованный или битый файл не валит весь архив — остальные всё равно перечисляем
+    try:
+        with opener() as member:
+            data = member.read(size + 1)
+    except ExtractionTimeout:
+        raise
+    except Exception as e:
+        yield f"{name} (не удалось прочитать: {e})\n"
+        return
+    if len(data) > size:
+        yield f"{name} (пропущен: размер не совпадает с заявленным)\n"
+        return
+    ctx.total_bytes += len(data)
+    yield f"\n--- {name} ---\n"
+    ctx.depth += 1
+    try:
+        yield from extractor(io.BytesIO(data), name.lower(), ctx)
+    except ExtractionTimeout:
+        raise
+    except Exception as e:
+        yield f"(не удалось прочитать: {e})\n"
+    finally:
+        ctx.depth -= 1
+
+
+@register([], backends=["textract"])
+def iter_textract(f, filename, ctx):
+    import textract
+    yield textract.process(filename, input_stream=f).decode("utf-8", errors="ignore")
+
+
+def extract_text(filename, source, limit, mime_type=None, limits=None):
+    # source — байты или путь к временному файлу
+    ctx = ExtractionContext(**(limits or {}))
+    f = open(source, "rb") if isinstance(source, str) else io.BytesIO(source)
+    parts = []
+    size = 0
+    try:
+        extractor = get_extractor(filename, mime_type)
+        for part in extractor(f, filename, ctx):
+            parts.append(part)
+            size += len(part)
+            if size >= limit:
+                break
+    finally:
+        f.close()
+    return "".join(parts)[:limit]
+
+
+# ------- Пул процессов --------
+def _init_worker(memory_mb, preload):
+    # Импорт бэкендов здесь, а не отдельной задачей: инициализатор выполняется в каждом
+    # воркере, включая воркеры перезапущенного пула, так что холодных не бывает
+    if preload:
+        warm_up(preload)
+    if memory_mb:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _ping():
+    return True
+
+
+def _on_alarm(signum, frame):
+    raise ExtractionTimeout()
+
+
+def _run_job(filename, source, limit, timeout, mime_type, limits):
+    # Таймаут внутри воркера: иначе зависший парсер так и держал бы процесс
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return extract_text(filename, source, limit, mime_type, limits)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class ExtractorPool:
+    def __init__(self, workers, timeout, memory_mb, max_tasks, archive_limits=None, preload=()):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.max_tasks = max_tasks
+        self.archive_limits = archive_limits or {}
+        # Бэкенды, которые каждый воркер импортирует при старте
+        self.preload = tuple(preload)
+        self._executor = None
+        self._jobs = 0
+        self._warming = []
+        self._slots = asyncio.Semaphore(workers)
+
+    def _get_executor(self):
+        if self._executor is not None and self.max_tasks and self._jobs >= self.max_tasks * self.workers:
+            # max_tasks_per_child с spawn на Python 3.11 подвешивает пул, когда воркер уходит
+            # на перезапуск, поэтому перезапускаем пул целиком: начатые задачи старый пул доделает
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.memory_mb, self.preload),
+            )
+            self._jobs = 0
+            # Пул сам поднимает процессы по мере задач: пустые задачи заставляют поднять все воркеры
+            # сразу, и инициализатор импортирует бэкенды до первого документа
+            self._warming = [self._executor.submit(_ping) for _ in range(self.workers)] if self.preload else []
+        self._jobs += 1
+        return self._executor
+
+    async def start(self):
+        self._get_executor()
+        self._jobs -= 1
+        await asyncio.gather(*[asyncio.wrap_future(f) for f in self._warming])
+
+    async def extract(self, filename, source, limit, mime_type=None):
+        loop = asyncio.get_running_loop()
+        # Очередь ждёт здесь, а не внутри пула: так таймаут считается от старта задачи
+        async with self._slots:
+            executor = self._get_executor()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(
+                        executor, _run_job, filename, source, limit, self.timeout, mime_type, self.archive_limits
+                    ),
+                    self.timeout + 5,
+                )
+            except BrokenProcessPool:
+                # Воркер упал (например, упёрся в лимит памяти) — пересоздаём пул
+                logging.warning("Extraction worker crashed on %s, restarting pool", filename)
+                self.shutdown()
+                raise MemoryError("Файл слишком тяжёлый для обработки")
+            except asyncio.TimeoutError:
+                raise ExtractionTimeout()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
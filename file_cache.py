@@ -0,0 +1,76 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+# Что кэшируем по файлу
+TEXT = "text"
+SUMMARY = "summary"
+TRANSCRIPT = "transcript"
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class FileCache:
+    # Ключ — хэш содержимого; file_unique_id Telegram позволяет найти его ещё до скачивания
+    def __init__(self, db, max_bytes, use_db):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.use_db = use_db
+        self._entries = OrderedDict()
+        self._aliases = OrderedDict()
+        self._bytes = 0
+        self._tasks = set()
+
+    async def get(self, kind, unique_id=None, digest=None):
+        if digest is None and unique_id is not None:
+            digest = self._aliases.get(unique_id)
+        if digest is not None:
+            entry = self._entries.get(digest)
+            if entry is not None and kind in entry:
+                self._entries.move_to_end(digest)
+                return entry[kind]
+        if not self.use_db:
+            return None
+        try:
+            value, digest = await self.db.get_cached_file(kind, unique_id, digest)
+        except Exception:
+            logging.exception("File cache lookup failed")
+            return None
+        if value is not None:
+            self._store(kind, unique_id, digest, value)
+        return value
+
+    def put(self, kind, unique_id, digest, value):
+        self._store(kind, unique_id, digest, value)
+        if self.use_db:
+            # В БД пишем в фоне — пользователь не должен ждать кэш
+            task = asyncio.create_task(self._persist(kind, unique_id, digest, value))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _persist(self, kind, unique_id, digest, value):
+        try:
+            await self.db.put_cached_file(kind, unique_id, digest, value)
+        except Exception:
+            logging.exception("Failed to persist file cache entry")
+
+    def _store(self, kind, unique_id, digest, value):
+        if unique_id is not None:
+            self._aliases[unique_id] = digest
+            self._aliases.move_to_end(unique_id)
+        entry = self._entries.setdefault(digest, {})
+        self._bytes -= len(entry.get(kind, ""))
+        entry[kind] = value
+        self._bytes += len(value)
+        self._entries.move_to_end(digest)
+        while self._entries and self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= sum(len(v) for v in evicted.values())
+        while len(self._aliases) > len(self._entries) * 4 + 1000:
+            self._aliases.popitem(last=False)
+
+    async def stop(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
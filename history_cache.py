@@ -0,0 +1,183 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+
+def as_utc(ts):
+    # Время реплик сравнивается с отметкой резюме, поэтому всегда в UTC с таймзоной
+    if ts is not None and ts.tzinfo is None:
+        return ts.replace(tzinfo=datetime.timezone.utc)
+    return ts
+
+
+class _UserHistory:
+    def __init__(self, turns, maxlen):
+        self.turns = deque(turns, maxlen=maxlen)
+        self.size = sum(len(content) for _, content, _ in self.turns)
+        self.touched = time.monotonic()
+
+    def append(self, turn):
+        if len(self.turns) == self.turns.maxlen:
+            self.size -= len(self.turns[0][1])
+        self.turns.append(turn)
+        self.size += len(turn[1])
+
+
+class HistoryCache:
+    # Последние реплики пользователей в памяти, запись в БД пачками в фоне.
+    # Очередь на запись ограничена max_pending_bytes: если БД долго лежит, старые реплики выбрасываются.
+    def __init__(self, db, max_turns, max_users, ttl, max_bytes, flush_interval, flush_batch, max_pending_bytes):
+        self.db = db
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_pending_bytes = max_pending_bytes
+        self._users = OrderedDict()
+        self._bytes = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._inflight = []
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def add(self, user_id, role, content):
+        turn = (role, content, datetime.datetime.now(datetime.timezone.utc))
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._bytes -= entry.size
+            entry.append(turn)
+            self._bytes += entry.size
+            self._touch(user_id, entry)
+        # Пока история пользователя не загружена, реплика живёт только в очереди на запись
+        self._pending.append((user_id, role, content, turn[2]))
+        self._pending_bytes += len(content)
+        self._trim()
+        if len(self._pending) >= self.flush_batch:
+            self._wake.set()
+
+    async def get(self, user_id, limit):
+        turns = await self.get_turns(user_id)
+        return [{"role": role, "content": content} for role, content, _ in turns[-limit:]]
+
+    async def get_turns(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is not None and time.monotonic() - entry.touched > self.ttl:
+            self._drop(user_id)
+            entry = None
+        if entry is None:
+            entry = await self._load(user_id)
+        self._touch(user_id, entry)
+        return list(entry.turns)
+
+    def loaded(self, user_id):
+        entry = self._users.get(user_id)
+        return entry is not None and time.monotonic() - entry.touched <= self.ttl
+
+    async def _load(self, user_id):
+        # Снимок незаписанных реплик — до ожидания БД: flush за это время может их закоммитить
+        unflushed = self.unflushed(user_id)
+        rows = await self.db.fetch_turns(user_id, limit=self.max_turns)
+        return self.seed(user_id, [(row["role"], row["content"], row["created_at"]) for row in rows], unflushed)
+
+    def unflushed(self, user_id):
+        return [(role, content, created_at) for uid, role, content, created_at in self._inflight + self._pending
+                if uid == user_id]
+
+    def seed(self, user_id, rows, unflushed=()):
+        # rows: (role, content, created_at) из БД, старые первыми; unflushed — снимок unflushed()
+        # до запроса к БД. Реплика могла дойти до БД, пока ждали ответ, — такие не дублируем.
+        turns = [(role, content, as_utc(created_at)) for role, content, created_at in rows]
+        stored = {(created_at, role, content) for role, content, created_at in turns}
+        extra = []
+        for role, content, created_at in list(unflushed) + self.unflushed(user_id):
+            key = (created_at, role, content)
+            if key not in stored:
+                stored.add(key)
+                extra.append((role, content, created_at))
+        turns.extend(sorted(extra, key=lambda turn: turn[2]))
+        entry = self._users.get(user_id)
+        if entry is not None and time.monotonic() - entry.touched <= self.ttl:
+            # Пока ждали БД, историю уже загрузил параллельный запрос
+            return entry
+        self._drop(user_id)
+        entry = _UserHistory(turns, self.max_turns)
+        self._users[user_id] = entry
+        self._bytes += entry.size
+        self._evict()
+        return entry
+
+    def _touch(self, user_id, entry):
+        entry.touched = time.monotonic()
+        self._users.move_to_end(user_id)
+        self._evict()
+
+    def _drop(self, user_id):
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._users and (len(self._users) > self.max_users or self._bytes > self.max_bytes):
+            user_id = next(iter(self._users))
+            self._drop(user_id)
+
+    def _sweep(self):
+        now = time.monotonic()
+        for user_id in [uid for uid, e in self._users.items() if now - e.touched > self.ttl]:
+            self._drop(user_id)
+
+    def _trim(self):
+        if self._pending_bytes <= self.max_pending_bytes:
+            return
+        dropped = 0
+        while dropped < len(self._pending) and self._pending_bytes > self.max_pending_bytes:
+            self._pending_bytes -= len(self._pending[dropped][2])
+            dropped += 1
+        del self._pending[:dropped]
+        metrics.HISTORY_DROPPED.inc(dropped)
+        logging.warning("History write queue is full, dropped %s oldest unsaved turns", dropped)
+
+    async def flush(self):
+        # Пачками не больше flush_batch: после простоя БД очередь уходит несколькими COPY, а не одним огромным
+        while self._pending:
+            self._inflight = self._pending[:self.flush_batch]
+            del self._pending[:self.flush_batch]
+            size = sum(len(content) for _, _, content, _ in self._inflight)
+            self._pending_bytes -= size
+            try:
+                await self.db.add_messages(self._inflight)
+            except Exception:
+                logging.exception("Failed to flush %s dialog turns, will retry", len(self._inflight))
+                self._pending[:0] = self._inflight
+                self._pending_bytes += size
+                self._trim()
+                return
+            finally:
+                self._inflight = []
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+            self._sweep()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict, defaultdict
+
+# Результат постановки задания
+STARTED = "started"
+USER_BUSY = "user_busy"
+BUSY = "busy"
+
+
+def normalize_prompt(prompt):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", prompt.lower())).strip()
+
+
+class ImageJobs:
+    # Картинки рисуются фоновыми заданиями: хендлер сразу отвечает и освобождает очередь чата
+    def __init__(self, max_concurrency, max_queued, per_user, cache_size, cache_ttl):
+        self.max_queued = max_queued
+        self.per_user = per_user
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._per_user = defaultdict(int)
+        self._tasks = set()
+        self._cache = OrderedDict()
+
+    def cached(self, prompt):
+        # file_id уже загруженной в Telegram картинки: повторная отправка ничего не стоит
+        key = normalize_prompt(prompt)
+        item = self._cache.get(key)
+        if item is None:
+            return None
+        file_id, created = item
+        if time.monotonic() - created > self.cache_ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return file_id
+
+    def remember(self, prompt, file_id):
+        key = normalize_prompt(prompt)
+        self._cache[key] = (file_id, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def admit(self, user_id):
+        # Примет ли submit задание прямо сейчас — чтобы не списывать запрос за то, что не нарисуем
+        if self._per_user.get(user_id, 0) >= self.per_user:
+            return USER_BUSY
+        if len(self._tasks) >= self.max_queued:
+            return BUSY
+        return STARTED
+
+    def submit(self, user_id, job):
+        status = self.admit(user_id)
+        if status != STARTED:
+            return status
+        self._per_user[user_id] += 1
+        task = asyncio.create_task(self._run(user_id, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return STARTED
+
+    async def _run(self, user_id, job):
+        try:
+            async with self._slots:
+                await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Image job failed for user %s", user_id)
+        finally:
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+    async def stop(self, timeout=30):
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -3,31 +3,124 @@ import logging
 import re
 import datetime
 import asyncio
-from io import BytesIO
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.enums import ParseMode
 from aiogram.client.bot import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
-import asyncpg
 from fastapi import FastAPI, Request
-from openai import OpenAI
-from pydub import AudioSegment
+from fastapi.responses import JSONResponse, Response
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
-# Документы
-import mimetypes
-import zipfile
-import rarfile
-from PyPDF2 import PdfReader
-from docx import Document as DocxDocument
-import csv
-import pandas as pd
-import pptx
-import xlrd
-import openpyxl
-import textract
+import ai_client
+from ai_client import openai_client, model_slot
+from utils import generate_image
+import update_queue
+from update_queue import UpdateQueue
+from streaming import stream_completion, finalize_text
+from history_cache import HistoryCache
+from context import ContextBuilder
+import extractors
+from extractors import ExtractorPool, ExtractionTimeout
+from summarizer import DocumentSummarizer
+import file_cache
+from file_cache import FileCache, content_hash
+import voice
+import vision
+from vision import AlbumCollector
+import downloads
+from downloads import FileTooLarge
+import image_jobs
+from image_jobs import ImageJobs
+from quota import QuotaEngine
+from entitlements import EntitlementCache
+from stats import Stats, today as stats_today
+from database import Database
+import migrations
+from migrations import HistoryMaintenance
+import metrics
+from metrics import timed
+from sender import SendScheduler, Broadcast
+import coalescer
+from coalescer import Coalescer
+import packager
+from config import (
+    UPDATE_WORKERS,
+    UPDATE_QUEUE_MAX,
+    UPDATE_QUEUE_PER_CHAT,
+    UPDATE_DEDUP_SIZE,
+    STREAM_REPLIES,
+    STREAM_EDIT_INTERVAL,
+    STREAM_MIN_DELTA,
+    HISTORY_CACHE_TURNS,
+    HISTORY_CACHE_USERS,
+    HISTORY_CACHE_TTL,
+    HISTORY_CACHE_MAX_BYTES,
+    HISTORY_FLUSH_INTERVAL,
+    HISTORY_FLUSH_BATCH,
+    HISTORY_PENDING_MAX_BYTES,
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_MAX_TURNS,
+    CONTEXT_FOLD_MIN_TURNS,
+    SUMMARY_MODEL,
+    SUMMARY_MAX_TOKENS,
+    DOC_WORKERS,
+    DOC_JOB_TIMEOUT,
+    DOC_WORKER_MEMORY_MB,
+    DOC_WORKER_MAX_TASKS,
+    DOC_MAX_CHARS,
+    DOC_CHUNK_TOKENS,
+    DOC_MAX_CHUNKS,
+    DOC_FANOUT,
+    DOC_SUMMARY_CONCURRENCY,
+    FILE_CACHE_MAX_BYTES,
+    FILE_CACHE_DB,
+    VOICE_CHUNK_SECONDS,
+    VOICE_MAX_PARALLEL,
+    VISION_ALBUM_WINDOW,
+    VISION_JPEG_QUALITY,
+    TELEGRAM_API_URL,
+    EXTRACTORS_WARMUP,
+    DOC_MAX_BYTES,
+    DOC_SPOOL_BYTES,
+    ARCHIVE_MAX_DEPTH,
+    ARCHIVE_MAX_RATIO,
+    ARCHIVE_MAX_TOTAL_BYTES,
+    ARCHIVE_MAX_MEMBERS,
+    IMAGE_MAX_CONCURRENCY,
+    IMAGE_MAX_QUEUED,
+    IMAGE_PER_USER,
+    IMAGE_CACHE_SIZE,
+    IMAGE_CACHE_TTL,
+    FREE_DAILY_LIMIT,
+    PAID_DAILY_LIMIT,
+    ENTITLEMENT_TTL,
+    ENTITLEMENT_CACHE_USERS,
+    STATS_REFRESH_INTERVAL,
+    STATS_FLUSH_INTERVAL,
+    HISTORY_PARTITION_MONTHS_AHEAD,
+    HISTORY_RETENTION_DAYS,
+    HISTORY_ARCHIVE,
+    HISTORY_MAINTENANCE_INTERVAL,
+    QUOTA_FLUSH_INTERVAL,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_STATEMENT_CACHE,
+    DB_COMMAND_TIMEOUT,
+    SEND_GLOBAL_RATE,
+    SEND_CHAT_RATE,
+    SEND_CHAT_BURST,
+    SEND_GROUP_RATE,
+    SEND_BULK_RATE,
+    SEND_MAX_RETRIES,
+    BROADCAST_PAGE_SIZE,
+    BROADCAST_CONCURRENCY,
+    COALESCE_WINDOW,
+    COALESCE_MAX_WAIT,
+)
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -38,104 +131,136 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID")
 DATABASE_URL = os.getenv("DATABASE_URL")
 OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID"))
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 app = FastAPI()
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-# --- Database logic
-class Database:
-    def __init__(self, dsn):
-        self.dsn = dsn
-        self.pool = None
-
-    async def connect(self):
-        self.pool = await asyncpg.create_pool(self.dsn)
-
-    async def disconnect(self):
-        if self.pool:
-            await self.pool.close()
-
-    async def add_user(self, user_id):
-        async with self.pool.acquire() as connection:
-            await connection.execute(
-                "INSERT INTO users (user_id, requests_today) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
-                user_id, 0
-            )
-
-    async def add_message(self, user_id, role, content):
-        async with self.pool.acquire() as connection:
-            await connection.execute(
-                "INSERT INTO dialog_history (user_id, role, content) VALUES ($1, $2, $3)",
-                user_id, role, content
-            )
-
-    async def get_history(self, user_id, limit=16):
-        async with self.pool.acquire() as connection:
-            rows = await connection.fetch(
-                """
-                SELECT role, content FROM dialog_history
-                WHERE user_id = $1
-                ORDER BY created_at DESC
-                LIMIT $2
-                """,
-                user_id, limit
-            )
-            return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
-
-    async def add_subscription(self, user_id, plan, payment_id):
-        async with self.pool.acquire() as connection:
-            if plan == 'monthly':
-                expires_at = "NOW() + INTERVAL '30 days'"
-            elif plan == 'yearly':
-                expires_at = "NOW() + INTERVAL '365 days'"
-            else:
-                raise ValueError("Unknown plan type")
-            await connection.execute(
-                f"""
-                INSERT INTO subscriptions 
-                    (user_id, plan, started_at, expires_at, payment_id, status) 
-                VALUES 
-                    ($1, $2, NOW(), {expires_at}, $3, 'active')
-                """,
-                user_id, plan, payment_id
-            )
-
-    async def get_user_subscription(self, user_id):
-        async with self.pool.acquire() as connection:
-            row = await connection.fetchrow(
-                """
-                SELECT plan, expires_at FROM subscriptions
-                WHERE user_id = $1 AND status = 'active' AND expires_at > NOW()
-                ORDER BY expires_at DESC
-                LIMIT 1
-                """,
-                user_id
-            )
-            return row
-
-    async def get_stats(self):
-        async with self.pool.acquire() as connection:
-            users = await connection.fetchval("SELECT COUNT(*) FROM users")
-            monthly = await connection.fetchval(
-                "SELECT COUNT(*) FROM subscriptions WHERE plan = 'monthly' AND status = 'active'")
-            yearly = await connection.fetchval(
-                "SELECT COUNT(*) FROM subscriptions WHERE plan = 'yearly' AND status = 'active'")
-            return users, monthly, yearly
-
-db = Database(DATABASE_URL)
+# Планировщик снаружи: метрики Bot API меряют сам запрос, а не ожидание в очереди
+scheduler = SendScheduler(
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    group_rate=SEND_GROUP_RATE,
+    bulk_rate=SEND_BULK_RATE,
+    max_retries=SEND_MAX_RETRIES,
+)
+bot.session.middleware(scheduler)
+bot.session.middleware(metrics.TelegramMetrics())
+metrics.SEND_QUEUE_DEPTH.set_function(lambda: scheduler.pending)
+
+db = Database(
+    DATABASE_URL,
+    min_size=DB_POOL_MIN,
+    max_size=DB_POOL_MAX,
+    statement_cache_size=DB_STATEMENT_CACHE,
+    command_timeout=DB_COMMAND_TIMEOUT,
+)
+history = HistoryCache(
+    db,
+    max_turns=HISTORY_CACHE_TURNS,
+    max_users=HISTORY_CACHE_USERS,
+    ttl=HISTORY_CACHE_TTL,
+    max_bytes=HISTORY_CACHE_MAX_BYTES,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+    flush_batch=HISTORY_FLUSH_BATCH,
+    max_pending_bytes=HISTORY_PENDING_MAX_BYTES,
+)
+context = ContextBuilder(
+    db,
+    history,
+    budget=CONTEXT_TOKEN_BUDGET,
+    max_turns=CONTEXT_MAX_TURNS,
+    fold_min_turns=CONTEXT_FOLD_MIN_TURNS,
+    summary_model=SUMMARY_MODEL,
+    summary_max_tokens=SUMMARY_MAX_TOKENS,
+    max_users=HISTORY_CACHE_USERS,
+)
+extractor_pool = ExtractorPool(
+    workers=DOC_WORKERS,
+    timeout=DOC_JOB_TIMEOUT,
+    memory_mb=DOC_WORKER_MEMORY_MB,
+    max_tasks=DOC_WORKER_MAX_TASKS,
+    archive_limits={
+        "max_depth": ARCHIVE_MAX_DEPTH,
+        "max_ratio": ARCHIVE_MAX_RATIO,
+        "max_total_bytes": ARCHIVE_MAX_TOTAL_BYTES,
+        "max_members": ARCHIVE_MAX_MEMBERS,
+    },
+    preload=extractors.backends() if EXTRACTORS_WARMUP == "all" else [m for m in EXTRACTORS_WARMUP.split(",") if m],
+)
+summarizer = DocumentSummarizer(
+    model="gpt-4o",
+    chunk_tokens=DOC_CHUNK_TOKENS,
+    max_chunks=DOC_MAX_CHUNKS,
+    fanout=DOC_FANOUT,
+    concurrency=DOC_SUMMARY_CONCURRENCY,
+)
+files = FileCache(db, max_bytes=FILE_CACHE_MAX_BYTES, use_db=FILE_CACHE_DB)
+entitlements = EntitlementCache(db, ttl=ENTITLEMENT_TTL, max_users=ENTITLEMENT_CACHE_USERS)
+db.subscription_listeners.append(lambda user_id, plan: entitlements.invalidate(user_id))
+stats = Stats(db, refresh_interval=STATS_REFRESH_INTERVAL, flush_interval=STATS_FLUSH_INTERVAL)
+history_maintenance = HistoryMaintenance(
+    lambda: db.pool,
+    months_ahead=HISTORY_PARTITION_MONTHS_AHEAD,
+    retention_days=HISTORY_RETENTION_DAYS,
+    archive=HISTORY_ARCHIVE,
+    interval=HISTORY_MAINTENANCE_INTERVAL,
+)
+db.subscription_listeners.append(stats.subscription_added)
+quota = QuotaEngine(
+    db,
+    entitlements,
+    free_limit=FREE_DAILY_LIMIT,
+    paid_limit=PAID_DAILY_LIMIT,
+    flush_interval=QUOTA_FLUSH_INTERVAL,
+    unlimited=[OWNER_CHAT_ID],
+)
+images = ImageJobs(
+    max_concurrency=IMAGE_MAX_CONCURRENCY,
+    max_queued=IMAGE_MAX_QUEUED,
+    per_user=IMAGE_PER_USER,
+    cache_size=IMAGE_CACHE_SIZE,
+    cache_ttl=IMAGE_CACHE_TTL,
+)
+broadcast = Broadcast(bot, db, page_size=BROADCAST_PAGE_SIZE, concurrency=BROADCAST_CONCURRENCY)
+
+async def load_user(user_id):
+    # Если чего-то из состояния пользователя нет в памяти — забираем всё одним запросом,
+    # а не по запросу на счётчик, подписку, резюме и историю
+    if all(c.loaded(user_id) for c in (history, quota, entitlements, context)):
+        return
+    unflushed = history.unflushed(user_id)
+    state = await db.load_user_state(user_id, HISTORY_CACHE_TURNS)
+    if state is None:
+        return
+    if state["created"]:
+        stats.user_added()
+    if not history.loaded(user_id):
+        history.seed(user_id, zip(state["roles"], state["contents"], state["created_ats"]), unflushed)
+    if not quota.loaded(user_id):
+        quota.seed(user_id, state)
+    if not entitlements.loaded(user_id):
+        sub = {"plan": state["plan"], "expires_at": state["expires_at"]} if state["plan"] else None
+        entitlements.seed(user_id, sub)
+    context.seed(user_id, state["summary"], state["summarized_until"])
+
+# Клавиатур всего две — собираем один раз, а не на каждый ответ
+USER_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="ПОМОЩЬ"), KeyboardButton(text="ПОДПИСКА")]],
+    resize_keyboard=True
+)
+OWNER_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="ПОМОЩЬ"), KeyboardButton(text="ПОДПИСКА"), KeyboardButton(text="АДМИН")]],
+    resize_keyboard=True
+)
 
 def get_main_keyboard(user_id):
-    buttons = [
-        [KeyboardButton(text="ПОМОЩЬ"), KeyboardButton(text="ПОДПИСКА")]
-    ]
-    if user_id == OWNER_CHAT_ID:
-        buttons[0].append(KeyboardButton(text="АДМИН"))
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    return OWNER_KEYBOARD if user_id == OWNER_CHAT_ID else USER_KEYBOARD
 
 @dp.message(CommandStart())
 async def cmd_start(message: types.Message):
-    await db.add_user(message.from_user.id)
+    if await db.add_user(message.from_user.id):
+        stats.user_added()
     keyboard = get_main_keyboard(message.from_user.id)
     await message.answer(
         "Привет! Я твой BEST FRIEND 🤖\nГотов помочь с любыми вопросами!",
@@ -156,7 +281,7 @@ async def help_command(message: types.Message):
         "    📝 <b>Текстовые запросы</b> (диалоги, статьи, переводы, стихи, идеи, коды и т.д.)\n\n"
         "    🎤 <b>Голосовые сообщения</b> — всё пойму, переведу в текст, отвечу.\n\n"
         "    🖼️ <b>Картинки и фото</b> — пришли, и я опишу, что на них, или сгенерирую новые по твоему описанию.\n\n"
-        "    📚 <b>Файлы и документы</b> — поддерживаются PDF, Word, Excel, PowerPoint, txt, csv, zip, rar и многие другие! Я читаю, конвертирую и анализирую (до 4000 символов из файла).\n\n"
+        "    📚 <b>Файлы и документы</b> — поддерживаются PDF, Word, Excel, PowerPoint, txt, csv, zip, rar и многие другие! Я читаю, конвертирую и анализирую — даже длинные документы целиком.\n\n"
         "<b>🚦 Как пользоваться:</b>\n\n"
         "    <b>Пиши или говори</b> — просто формулируй любой вопрос, просьбу или задачу. Например, - \"составь курс обучения по...\"\n\n"
         "    <b>Для картинок</b> — начинай с «нарисуй», «создай», «сделай картинку…» (или пиши по-английски: generate, draw…).\n\n"
@@ -187,7 +312,7 @@ async def help_command(message: types.Message):
 async def sub_command(message: types.Message):
     sub_url = "https://your-payment-link.com"
     user_id = message.from_user.id
-    sub = await db.get_user_subscription(user_id)
+    sub = await entitlements.get(user_id)
     if sub is None:
         text = (
             "😔 <b>Подписка не активна</b>\n\n"
@@ -211,31 +336,111 @@ async def sub_command(message: types.Message):
 async def admin_stats(message: types.Message):
     if message.from_user.id != OWNER_CHAT_ID:
         return
-    users, monthly, yearly = await db.get_stats()
     msg = (
         f"<b>Статистика 👑</b>\n"
-        f"Пользователей: <b>{users}</b>\n"
-        f"Месячных подписок: <b>{monthly}</b>\n"
-        f"Годовых подписок: <b>{yearly}</b>"
+        f"Пользователей: <b>{stats.users}</b>\n"
+        f"Месячных подписок: <b>{stats.plans.get('monthly', 0)}</b>\n"
+        f"Годовых подписок: <b>{stats.plans.get('yearly', 0)}</b>\n\n"
+        f"Активных сегодня: <b>{stats.active_today}</b>\n"
+        f"Сообщений сегодня: <b>{stats.messages_today}</b>"
     )
+    history_rows = await db.get_daily_stats(8)
+    past = [row for row in history_rows if row["day"] != stats_today()][:7]
+    if past:
+        msg += "\n\n<b>По дням</b> (активные / сообщения):\n" + "\n".join(
+            f"{row['day'].strftime('%d.%m')}: {row['active_users']} / {row['messages']}" for row in past
+        )
     await message.answer(msg, reply_markup=get_main_keyboard(message.from_user.id))
 
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != OWNER_CHAT_ID:
+        return
+    keyboard = get_main_keyboard(message.from_user.id)
+    if not command.args:
+        await message.answer("Напиши текст рассылки: <code>/broadcast текст</code>", reply_markup=keyboard)
+        return
+
+    async def report(sent, failed):
+        await message.answer(
+            f"📣 Рассылка завершена: доставлено <b>{sent}</b>, не доставлено <b>{failed}</b>.",
+            reply_markup=keyboard
+        )
+
+    if broadcast.start(command.args, report):
+        await message.answer("📣 Рассылка запущена, пришлю итог, когда закончу.", reply_markup=keyboard)
+    else:
+        await message.answer("Рассылка уже идёт — дождись её окончания.", reply_markup=keyboard)
+
 @app.on_event("startup")
 async def on_startup():
+    scheduler.start()
     await db.connect()
+    await migrations.migrate(db.dsn)
+    history_maintenance.start()
     logging.info("Database connected")
+    history.start()
+    quota.start()
+    await stats.start()
     await bot.delete_my_commands()
+    if EXTRACTORS_WARMUP:
+        await extractor_pool.start()
+    updates.start()
 
 @app.on_event("shutdown")
 async def on_shutdown():
+    await updates.stop()
+    await broadcast.stop()
+    await images.stop()
+    await albums.stop()
+    await turns.stop()
+    await scheduler.stop()
+    await context.stop()
+    await history.stop()
+    await quota.stop()
+    await stats.stop()
+    await history_maintenance.stop()
+    await files.stop()
     await db.disconnect()
     logging.info("Database disconnected")
+    extractor_pool.shutdown()
+    await ai_client.close()
+
+async def process_update(update):
+    if update.message and update.message.from_user:
+        stats.seen(update.message.from_user.id)
+    await dp.feed_update(bot, update)
+
+updates = UpdateQueue(
+    process_update,
+    workers=UPDATE_WORKERS,
+    max_pending=UPDATE_QUEUE_MAX,
+    max_per_chat=UPDATE_QUEUE_PER_CHAT,
+    dedup_size=UPDATE_DEDUP_SIZE,
+)
+metrics.UPDATE_QUEUE_DEPTH.set_function(lambda: updates.pending)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    body = await request.json()
-    update = types.Update(**body)
-    await dp.feed_update(bot, update)
+    try:
+        body = await request.json()
+        update = types.Update(**body)
+    except Exception:
+        # Битый апдейт повторять бессмысленно — подтверждаем и забываем
+        logging.warning("Invalid webhook payload")
+        return {"ok": True}
+    status = updates.put(update)
+    metrics.WEBHOOK_UPDATES.labels(status).inc()
+    if status == update_queue.SATURATED:
+        # Очередь переполнена: Telegram повторит доставку позже
+        return JSONResponse({"ok": False}, status_code=503, headers={"Retry-After": "5"})
+    if status == update_queue.CHAT_FULL:
+        logging.warning("Dropping update %s: chat queue is full", update.update_id)
     return {"ok": True}
 
 IMAGE_KEYWORDS = [
@@ -243,51 +448,63 @@ IMAGE_KEYWORDS = [
     r"^(generate|draw|create|make)\s*(image|picture)?",
 ]
 
-def should_send_as_file(text):
-    if re.search(r"```.*?```", text, re.DOTALL):
-        return True
-    if re.match(r"^\s*(def |class |import |from |#|\/\/|<\w+)", text.strip()):
-        return True
-    lines = text.strip().split("\n")
-    if len(lines) > 8 and any(sym in lines[0] for sym in ("def", "class", "import", "from", "#", "//", "<")):
-        return True
-    if re.search(r"(def |class |import |from |#|\/\/|<\w+)", text):
-        return True
-    return False
+# Один проход: есть блок кода или ответ сам начинается как код
+CODE_ANSWER = re.compile(r"```|\A\s*(?:def |class |import |from \S+ import |#!|#include|//|<[a-zA-Z!])")
 
-async def generate_filename(prompt, answer):
-    system_prompt = (
-        "Ты помощник для Telegram. На входе описание задачи и текст ответа с кодом. "
-        "Верни ТОЛЬКО короткое английское название файла (без лишнего текста), не более 3 слов, через нижнее подчёркивание, всегда с расширением .txt, "
-        "пример: snake_game.txt, telegram_bot.txt, sql_export_script.txt"
-    )
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Запрос: {prompt}\nОтвет:\n{answer}\n"},
-        ],
-        max_tokens=20,
-        temperature=0.1
-    )
-    name = response.choices[0].message.content.strip()
-    if not name.endswith(".txt"):
-        name = "answer.txt"
-    return name
+def should_send_as_file(text):
+    return CODE_ANSWER.search(text) is not None
 
 def is_time_question(text):
     text = text.lower()
     return bool(re.search(r"\b(время|час|time)\b", text))
 
+def is_command(text):
+    # Картинка и время распознаются по самому тексту: склеенные с соседними сообщениями, они бы потерялись
+    t = text.strip().lower()
+    return is_time_question(text) or any(re.match(pattern, t) for pattern in IMAGE_KEYWORDS)
+
 @dp.message(F.text)
 async def universal_image_handler(message: types.Message):
-    await handle_text_or_image(message, message.text)
+    # Возвращаемся сразу: ответ соберёт коалесцер, а очередь чата пойдёт дальше
+    turns.add(message, message.text, alone=is_command(message.text))
 
+async def send_quota_exceeded(message):
+    await message.answer(
+        "⏳ <b>Дневной лимит запросов исчерпан</b>\n\n"
+        "Лимит обновится завтра. Оформи подписку через кнопку ПОДПИСКА, чтобы снять ограничения.",
+        reply_markup=get_main_keyboard(message.from_user.id)
+    )
+
+IMAGE_READY_CAPTION = "Готово! Если хочешь ещё — просто напиши новый запрос."
+
+async def render_image(message, desc):
+    user_id = message.from_user.id
+    try:
+        async with metrics.observe(metrics.HANDLER_SECONDS, "image_generation"):
+            image_url = await generate_image(desc)
+        sent = await message.answer_photo(image_url, caption=IMAGE_READY_CAPTION, reply_markup=get_main_keyboard(user_id))
+        if sent.photo:
+            images.remember(desc, sent.photo[-1].file_id)
+    except Exception:
+        logging.exception("Image generation failed")
+        await message.answer("Ошибка при генерации картинки 😔", reply_markup=get_main_keyboard(user_id))
+
+async def consume_turn(user_id):
+    # Ход, который заменил отменённый (уже оплаченный), второй раз не списываем
+    if coalescer.paid():
+        return True
+    if not await quota.consume(user_id):
+        return False
+    coalescer.charged()
+    return True
+
+@timed("handle_text_or_image")
 async def handle_text_or_image(message, text):
     user_id = message.from_user.id
     t = text.strip().lower()
     if t in ["помощь", "подписка", "админ"]:
         return
+    await load_user(user_id)
 
     for pattern in IMAGE_KEYWORDS:
         m = re.match(pattern, t)
@@ -296,31 +513,58 @@ async def handle_text_or_image(message, text):
             if not desc:
                 await message.answer("Опиши, что нужно нарисовать 👩‍🎨", reply_markup=get_main_keyboard(user_id))
                 return
-            try:
-                response = openai_client.images.generate(
-                    model="dall-e-3",
-                    prompt=desc,
-                    n=1,
-                    size="1024x1024"
-                )
-                image_url = response.data[0].url
-                await message.answer_photo(image_url, caption="Готово! Если хочешь ещё — просто напиши новый запрос.", reply_markup=get_main_keyboard(user_id))
-            except Exception as e:
-                await message.answer("Ошибка при генерации картинки 😔", reply_markup=get_main_keyboard(user_id))
+            # Повтор уже нарисованной картинки бесплатен, как и другие попадания в кэш;
+            # запрос списываем, только если рисовать действительно начнём
+            file_id = images.cached(desc)
+            if file_id:
+                await message.answer_photo(file_id, caption=IMAGE_READY_CAPTION, reply_markup=get_main_keyboard(user_id))
+                return
+            status = images.admit(user_id)
+            if status == image_jobs.STARTED:
+                if not await consume_turn(user_id):
+                    await send_quota_exceeded(message)
+                    return
+                status = images.submit(user_id, lambda: render_image(message, desc))
+            if status == image_jobs.USER_BUSY:
+                await message.answer("Я ещё рисую твои прошлые картинки — дождись их, пожалуйста 🎨", reply_markup=get_main_keyboard(user_id))
+            elif status == image_jobs.BUSY:
+                await message.answer("Сейчас очень много заказов на картинки 😅 Попробуй через пару минут.", reply_markup=get_main_keyboard(user_id))
+            else:
+                await message.answer("🎨 Рисую… Пришлю картинку, как только она будет готова.", reply_markup=get_main_keyboard(user_id))
             return
     if is_time_question(text):
         now = datetime.datetime.now().strftime("%H:%M:%S")
         await message.answer(f"Сейчас {now}", reply_markup=get_main_keyboard(user_id))
         return
 
-    await db.add_message(user_id, "user", text)
-    history = await db.get_history(user_id, limit=16)
+    if not await consume_turn(user_id):
+        await send_quota_exceeded(message)
+        return
+    await history.add(user_id, "user", text)
+    coalescer.record()
+    messages = await context.build(user_id)
+    await reply_with_completion(message, messages)
+
+turns = Coalescer(handle_text_or_image, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT)
+
+async def reply_with_completion(message, messages):
+    # Ответ модели на собранный контекст: стриминг или целиком, текстом или файлом
+    user_id = message.from_user.id
+    placeholder = None
     try:
-        gpt_response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=history,
-        )
-        answer = gpt_response.choices[0].message.content
+        if STREAM_REPLIES:
+            placeholder = await message.answer("✍️ …", reply_markup=get_main_keyboard(user_id))
+            answer, as_file = await stream_completion(
+                placeholder, messages, should_send_as_file, STREAM_EDIT_INTERVAL, STREAM_MIN_DELTA
+            )
+        else:
+            async with model_slot("gpt-4o"):
+                gpt_response = await openai_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                )
+            answer = gpt_response.choices[0].message.content
+            as_file = should_send_as_file(answer)
 
         SEARCH_TRIGGERS = [
             "не имею доступа к текущему времени",
@@ -340,150 +584,206 @@ async def handle_text_or_image(message, text):
 
         if any(x in answer.lower() for x in SEARCH_TRIGGERS):
             answer = "Я не нашёл свежей информации по твоему запросу."
-
-        await db.add_message(user_id, "assistant", answer)
-
-        if should_send_as_file(answer):
-            file_name = await generate_filename(text, answer)
-            with open(file_name, "w", encoding="utf-8") as f:
-                f.write(answer)
-            with open(file_name, "rb") as f:
-                await message.answer_document(types.BufferedInputFile(f.read(), file_name), caption="Готово! Вот твой файл 👇", reply_markup=get_main_keyboard(user_id))
-            os.remove(file_name)
+            as_file = False
+
+        coalescer.settle()
+        await history.add(user_id, "assistant", answer)
+
+        if as_file:
+            document, prose = packager.package(answer)
+            if prose and placeholder:
+                await finalize_text(placeholder, message, prose, get_main_keyboard(user_id))
+                placeholder = None
+            elif prose:
+                await message.answer(prose, reply_markup=get_main_keyboard(user_id))
+            caption = "Готово! Файлы в архиве 👇" if document.filename == packager.ARCHIVE_NAME else "Готово! Вот твой файл 👇"
+            await message.answer_document(document, caption=caption, reply_markup=get_main_keyboard(user_id))
+            if placeholder:
+                await placeholder.delete()
+        elif placeholder:
+            await finalize_text(placeholder, message, answer, get_main_keyboard(user_id))
         else:
             await message.answer(answer, reply_markup=get_main_keyboard(user_id))
+    except asyncio.CancelledError:
+        # Пользователь дописал вопрос — этот ответ больше не нужен
+        if placeholder:
+            try:
+                await placeholder.delete()
+            except Exception:
+                pass
+        raise
     except Exception:
+        logging.exception("Chat completion failed")
+        if placeholder:
+            try:
+                await placeholder.delete()
+            except Exception:
+                pass
         await message.answer("Ошибка при получении ответа от ИИ 🤖", reply_markup=get_main_keyboard(user_id))
 
 # ------- Голосовые сообщения (Whisper + GPT-4o + генерация картинок) --------
 @dp.message(F.voice)
+@timed("handle_voice")
 async def handle_voice(message: types.Message):
     user_id = message.from_user.id
     file_id = message.voice.file_id
+    unique_id = message.voice.file_unique_id
+    user_text = await files.get(file_cache.TRANSCRIPT, unique_id=unique_id)
+    if user_text is not None:
+        turns.add(message, user_text, alone=is_command(user_text))
+        return
     file = await bot.get_file(file_id)
-    ogg_path = f"voice_{user_id}.ogg"
-    wav_path = f"voice_{user_id}.wav"
-    await bot.download_file(file.file_path, ogg_path)
     try:
-        audio = AudioSegment.from_file(ogg_path, format="ogg")
-        audio.export(wav_path, format="wav")
+        data = await voice.download(bot, file.file_path)
     except Exception:
         await message.answer("Не получилось обработать голосовое 😢", reply_markup=get_main_keyboard(user_id))
         return
-    try:
-        with open(wav_path, "rb") as audio_file:
-            transcript = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                response_format="text",
-                language="ru"
-            )
-        user_text = transcript.text if hasattr(transcript, "text") else str(transcript)
-    except Exception:
-        await message.answer("Ошибка при распознавании голосового 😔", reply_markup=get_main_keyboard(user_id))
-        return
-    finally:
+    digest = content_hash(data)
+    user_text = await files.get(file_cache.TRANSCRIPT, digest=digest)
+    paid = False
+    if user_text is None:
+        # Whisper платный: квоту проверяем до распознавания, а попавший в ход текст второй раз не списываем
+        await load_user(user_id)
+        if not await quota.consume(user_id):
+            await send_quota_exceeded(message)
+            return
+        paid = True
         try:
-            os.remove(ogg_path)
-            os.remove(wav_path)
+            user_text = await voice.transcribe(
+                data, message.voice.duration or 0, VOICE_CHUNK_SECONDS, VOICE_MAX_PARALLEL
+            )
         except Exception:
-            pass
-    await handle_text_or_image(message, user_text)
+            await message.answer("Ошибка при распознавании голосового 😔", reply_markup=get_main_keyboard(user_id))
+            return
+    files.put(file_cache.TRANSCRIPT, unique_id, digest, user_text)
+    turns.add(message, user_text, paid, alone=is_command(user_text))
 
 # ------- Распознавание изображений (GPT-4o Vision) --------
 @dp.message(F.photo)
+@timed("handle_photo")
 async def handle_photo(message: types.Message):
-    pass  # Можно вставить сюда распознавание фото через vision, если потребуется
+    if message.media_group_id:
+        # Альбом соберётся целиком и уйдёт одним запросом
+        albums.add(message)
+        return
+    await answer_photos([message])
+
+@timed("answer_photos")
+async def answer_photos(messages):
+    message = messages[0]
+    user_id = message.from_user.id
+    caption = next((m.caption for m in messages if m.caption), "")
+    await load_user(user_id)
+    if not await quota.consume(user_id):
+        await send_quota_exceeded(message)
+        return
+    detail = vision.detail_for(caption)
+    try:
+        urls = await asyncio.gather(*(
+            vision.prepare(bot, m.photo, detail, VISION_JPEG_QUALITY) for m in messages
+        ))
+    except Exception:
+        logging.exception("Photo download failed")
+        await message.answer("Не получилось загрузить фото 😢", reply_markup=get_main_keyboard(user_id))
+        return
+    prompt = caption or vision.DEFAULT_PROMPT
+    # В историю идёт только подпись: картинки в следующие запросы не тащим
+    recorded = f"[Фото: {len(urls)}] {prompt}"
+    await history.add(user_id, "user", recorded)
+    chat = await context.build(user_id)
+    # Записанную подпись заменяем самими картинками. Ищем её по тексту, а не берём последнюю:
+    # между записью и сборкой контекста в историю мог попасть текстовый ход того же пользователя
+    for i in range(len(chat) - 1, -1, -1):
+        if chat[i]["role"] == "user" and chat[i]["content"] == recorded:
+            del chat[i]
+            break
+    chat.append({"role": "user", "content": vision.content(prompt, urls, detail)})
+    await reply_with_completion(message, chat)
+
+albums = AlbumCollector(answer_photos, window=VISION_ALBUM_WINDOW)
 
 # ------- Распознавание документов (GPT-4o + резюме) --------
+async def send_document_summary(message, doc, summary):
+    await message.answer(
+        f"📄 <b>Файл:</b> <i>{doc.file_name}</i>\n\n<b>Резюме документа:</b>\n{summary}",
+        reply_markup=get_main_keyboard(message.from_user.id),
+        parse_mode="HTML"
+    )
+
 @dp.message(F.document)
+@timed("handle_document")
 async def handle_document(message: types.Message):
     user_id = message.from_user.id
     doc = message.document
     filename = doc.file_name.lower()
-    file = await bot.get_file(doc.file_id)
-    f = BytesIO()
-    await bot.download_file(file.file_path, destination=f)
-    f.seek(0)
-
-    text = ""
-    error = None
+    summary = await files.get(file_cache.SUMMARY, unique_id=doc.file_unique_id)
+    if summary is not None:
+        await send_document_summary(message, doc, summary)
+        return
+    too_large = f"❌ Файл слишком большой, максимум {DOC_MAX_BYTES // (1024 * 1024)} МБ."
+    if doc.file_size and doc.file_size > DOC_MAX_BYTES:
+        await message.answer(too_large, reply_markup=get_main_keyboard(user_id))
+        return
     try:
-        if filename.endswith('.pdf'):
-            pdf = PdfReader(f)
-            text = "".join([page.extract_text() or "" for page in pdf.pages])
-        elif filename.endswith('.docx'):
-            docx_file = DocxDocument(f)
-            text = "\n".join([p.text for p in docx_file.paragraphs])
-        elif filename.endswith('.txt'):
-            text = f.read().decode('utf-8', errors='ignore')
-        elif filename.endswith('.csv'):
-            f.seek(0)
-            lines = []
-            reader = csv.reader(f.read().decode('utf-8', errors='ignore').splitlines())
-            for row in reader:
-                lines.append(','.join(row))
-            text = "\n".join(lines)
-        elif filename.endswith('.xlsx'):
-            wb = openpyxl.load_workbook(f, read_only=True)
-            ws = wb.active
-            lines = []
-            for row in ws.iter_rows(values_only=True):
-                lines.append("\t".join([str(cell) for cell in row if cell is not None]))
-            text = "\n".join(lines)
-        elif filename.endswith('.xls'):
-            book = xlrd.open_workbook(file_contents=f.read())
-            sheet = book.sheet_by_index(0)
-            lines = []
-            for rx in range(sheet.nrows):
-                lines.append("\t".join([str(cell) for cell in sheet.row_values(rx)]))
-            text = "\n".join(lines)
-        elif filename.endswith('.pptx'):
-            ppt = pptx.Presentation(f)
-            slides = []
-            for slide in ppt.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        slides.append(shape.text)
-            text = "\n".join(slides)
-        elif filename.endswith('.zip'):
-            z = zipfile.ZipFile(f)
-            file_list = z.namelist()
-            text = "ZIP-файл, содержит:\n" + "\n".join(file_list)
-        elif filename.endswith('.rar'):
-            r = rarfile.RarFile(f)
-            file_list = r.namelist()
-            text = "RAR-файл, содержит:\n" + "\n".join(file_list)
-        else:
+        buffer = await downloads.download(bot, doc.file_id, DOC_MAX_BYTES, DOC_SPOOL_BYTES)
+    except FileTooLarge:
+        await message.answer(too_large, reply_markup=get_main_keyboard(user_id))
+        return
+    try:
+        digest = buffer.digest
+        summary = await files.get(file_cache.SUMMARY, digest=digest)
+        if summary is not None:
+            files.put(file_cache.SUMMARY, doc.file_unique_id, digest, summary)
+            await send_document_summary(message, doc, summary)
+            return
+
+        # Отказы по размеру и готовое резюме бесплатны — запрос списываем перед извлечением и GPT
+        await load_user(user_id)
+        if not await quota.consume(user_id):
+            await send_quota_exceeded(message)
+            return
+        text = await files.get(file_cache.TEXT, digest=digest) or ""
+        error = None
+        if not text:
             try:
-                text = textract.process(filename, input_stream=f).decode('utf-8', errors='ignore')
-            except Exception:
-                error = "Не удалось прочитать файл этим методом."
-    except Exception as e:
-        error = f"Ошибка при чтении файла: {e}"
+                text = await extractor_pool.extract(filename, buffer.source(), DOC_MAX_CHARS, doc.mime_type)
+                if text:
+                    files.put(file_cache.TEXT, doc.file_unique_id, digest, text)
+            except ExtractionTimeout:
+                error = "Файл слишком долго обрабатывается."
+            except Exception as e:
+                error = f"Ошибка при чтении файла: {e}"
+    finally:
+        buffer.close()
 
     if text:
-        chunk = text[:4000]
-        prompt = (
-            f"Сделай краткое, структурированное резюме по этому тексту (выдели основные моменты, сохрани факты, пиши лаконично):\n\n{chunk}"
-        )
+        status = await message.answer("📄 Читаю документ…")
+        last_update = 0.0
+
+        async def report_progress(done, total):
+            nonlocal last_update
+            now = asyncio.get_running_loop().time()
+            if done < total and now - last_update < 2:
+                return
+            last_update = now
+            try:
+                await status.edit_text(f"📄 Читаю документ: {done}/{total} частей…")
+            except Exception:
+                pass
+
         try:
-            gpt_response = openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "Ты профессиональный ассистент, делаешь структурированные краткие резюме по тексту документа, не придумываешь фактов."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=600
-            )
-            summary = gpt_response.choices[0].message.content.strip()
-            await message.answer(
-                f"📄 <b>Файл:</b> <i>{doc.file_name}</i>\n\n<b>Резюме документа:</b>\n{summary}",
-                reply_markup=get_main_keyboard(user_id),
-                parse_mode="HTML"
-            )
+            summary, truncated = await summarizer.summarize(text, progress=report_progress)
+            if truncated or len(text) >= DOC_MAX_CHARS:
+                summary += "\n\n<i>Документ очень большой — резюме составлено по его первой части.</i>"
+            files.put(file_cache.SUMMARY, doc.file_unique_id, digest, summary)
+            await send_document_summary(message, doc, summary)
         except Exception as e:
             await message.answer(f"Ошибка при резюмировании через GPT: {e}", reply_markup=get_main_keyboard(user_id))
+        finally:
+            try:
+                await status.delete()
+            except Exception:
+                pass
     else:
         await message.answer(f"❌ Не удалось прочитать документ. {error or ''}", reply_markup=get_main_keyboard(user_id))
 
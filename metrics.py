@@ -0,0 +1,77 @@
+import functools
+import time
+from contextlib import asynccontextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Бакеты под наши задержки: от миллисекунд БД до минутных генераций
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время обработки апдейта хендлером", ["handler"], buckets=SLOW_BUCKETS
+)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Необработанные ошибки хендлеров", ["handler"])
+OPENAI_SECONDS = Histogram(
+    "bot_openai_seconds", "Длительность вызова OpenAI", ["model"], buckets=SLOW_BUCKETS
+)
+OPENAI_WAIT_SECONDS = Histogram(
+    "bot_openai_slot_wait_seconds", "Ожидание слота конкурентности OpenAI", ["model"], buckets=FAST_BUCKETS
+)
+OPENAI_IN_FLIGHT = Gauge("bot_openai_in_flight", "Вызовы OpenAI в процессе", ["model"])
+DB_ACQUIRE_SECONDS = Histogram(
+    "bot_db_acquire_seconds", "Ожидание соединения из пула asyncpg", buckets=FAST_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время работы с соединением", ["query"], buckets=FAST_BUCKETS
+)
+UPDATE_QUEUE_DEPTH = Gauge("bot_update_queue_depth", "Апдейты в очереди вебхука")
+WEBHOOK_UPDATES = Counter("bot_webhook_updates_total", "Апдейты, пришедшие на вебхук", ["status"])
+TELEGRAM_SECONDS = Histogram(
+    "bot_telegram_request_seconds", "Длительность запросов к Bot API", ["method"], buckets=SLOW_BUCKETS
+)
+SEND_WAIT_SECONDS = Histogram(
+    "bot_send_wait_seconds", "Ожидание очереди исходящих запросов к Bot API", ["priority"], buckets=SLOW_BUCKETS
+)
+SEND_QUEUE_DEPTH = Gauge("bot_send_queue_depth", "Исходящие запросы в очереди")
+SEND_RETRIES = Counter("bot_send_retries_total", "Повторы после 429 retry_after")
+HISTORY_DROPPED = Counter("bot_history_dropped_total", "Реплики, выброшенные из переполненной очереди записи в БД")
+
+
+def timed(handler):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(handler).inc()
+                raise
+            finally:
+                HANDLER_SECONDS.labels(handler).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@asynccontextmanager
+async def observe(histogram, *labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(*labels) if labels else histogram).observe(time.perf_counter() - start)
+
+
+class TelegramMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            TELEGRAM_SECONDS.labels(type(method).__name__).observe(time.perf_counter() - start)
+
+
+def render():
+    return generate_latest(), CONTENT_TYPE_LATEST
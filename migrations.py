@@ -0,0 +1,358 @@
+import asyncio
+import datetime
+import logging
+import re
+
+import asyncpg
+
+# Любой постоянный ключ: не даёт двум процессам накатывать миграции одновременно
+MIGRATION_LOCK = 0x6266626F74
+
+BASELINE = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    requests_today INTEGER NOT NULL DEFAULT 0
+);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS requests_date DATE;
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    plan TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMPTZ NOT NULL,
+    payment_id TEXT,
+    status TEXT NOT NULL DEFAULT 'active'
+);
+CREATE INDEX IF NOT EXISTS subscriptions_user_expires_idx ON subscriptions (user_id, expires_at DESC);
+
+CREATE TABLE IF NOT EXISTS dialog_history (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS dialog_summary (
+    user_id BIGINT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summarized_until TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day DATE PRIMARY KEY,
+    active_users INTEGER NOT NULL DEFAULT 0,
+    messages INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS file_cache (
+    content_hash TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (content_hash, kind)
+);
+CREATE TABLE IF NOT EXISTS file_cache_alias (
+    file_unique_id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+"""
+
+async def history_index(connection):
+    # CONCURRENTLY нельзя внутри транзакции, зато запись в таблицу не блокируется на время построения.
+    # Прерванная сборка оставляет INVALID индекс, который IF NOT EXISTS молча пропустил бы, — сносим его
+    valid = await connection.fetchval(
+        """
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = 'dialog_history_user_created_idx' AND c.relnamespace = current_schema()::regnamespace
+        """
+    )
+    if valid is False:
+        logging.warning("Dropping invalid index dialog_history_user_created_idx left by an interrupted build")
+        await connection.execute("DROP INDEX CONCURRENTLY dialog_history_user_created_idx")
+    await connection.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS dialog_history_user_created_idx "
+        "ON dialog_history (user_id, created_at DESC)"
+    )
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(value):
+    return month_start(value + datetime.timedelta(days=32))
+
+
+def partition_name(start):
+    return f"dialog_history_y{start.year}m{start.month:02d}"
+
+
+async def partition_history(connection):
+    # Превращаем dialog_history в секционированную по месяцам created_at.
+    # Старые данные не переливаем: прежняя таблица подключается секцией «всё до следующего месяца».
+    # Миграция вне общей транзакции: долгие проходы по таблице идут без эксклюзивной блокировки,
+    # а под ней — только короткая подмена таблиц в конце.
+    kind = await connection.fetchval("SELECT relkind::text FROM pg_class WHERE oid = 'dialog_history'::regclass")
+    if kind == "p":
+        return
+    boundary = next_month(datetime.datetime.now(datetime.timezone.utc))
+    nullable = await connection.fetchval(
+        """
+        SELECT is_nullable = 'YES' FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'dialog_history' AND column_name = 'created_at'
+        """
+    )
+    if nullable:
+        # UPDATE держит только ROW EXCLUSIVE: запись из других реплик идёт параллельно
+        await connection.execute("UPDATE dialog_history SET created_at = 'epoch' WHERE created_at IS NULL")
+    # CHECK, совпадающий с границей секции, избавляет ATTACH от проверки всей таблицы под ACCESS EXCLUSIVE.
+    # NOT VALID ставится мгновенно, а VALIDATE сканирует таблицу под SHARE UPDATE EXCLUSIVE, не мешая записи.
+    # Ограничение от прерванного прошлого запуска пересоздаём: граница могла сдвинуться на месяц.
+    await connection.execute("ALTER TABLE dialog_history DROP CONSTRAINT IF EXISTS dialog_history_legacy_range")
+    await connection.execute(
+        "ALTER TABLE dialog_history ADD CONSTRAINT dialog_history_legacy_range "
+        f"CHECK (created_at IS NOT NULL AND created_at < '{boundary.isoformat()}') NOT VALID"
+    )
+    await connection.execute("ALTER TABLE dialog_history VALIDATE CONSTRAINT dialog_history_legacy_range")
+    sequence = await connection.fetchval(
+        """
+        SELECT pg_get_serial_sequence('dialog_history', 'id') FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'dialog_history' AND column_name = 'id'
+        """
+    )
+
+    async with connection.transaction():
+        await connection.execute("ALTER TABLE dialog_history RENAME TO dialog_history_legacy")
+        await connection.execute("ALTER INDEX IF EXISTS dialog_history_user_created_idx RENAME TO dialog_history_legacy_user_created_idx")
+        await connection.execute(
+            "CREATE TABLE dialog_history (LIKE dialog_history_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+        )
+        if sequence:
+            # Последовательность id не должна умереть вместе со старой секцией при очистке
+            await connection.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        await connection.execute("CREATE INDEX dialog_history_user_created_idx ON dialog_history (user_id, created_at DESC)")
+        await connection.execute("CREATE TABLE dialog_history_default PARTITION OF dialog_history DEFAULT")
+
+        # Проверяем уже под блокировкой от RENAME: реплики могли дописать строки, пока шёл VALIDATE
+        if await connection.fetchval("SELECT EXISTS (SELECT 1 FROM dialog_history_legacy)"):
+            await connection.execute(
+                "ALTER TABLE dialog_history ATTACH PARTITION dialog_history_legacy "
+                f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+            )
+        else:
+            await connection.execute("DROP TABLE dialog_history_legacy")
+            await ensure_partitions(connection, month_start(datetime.datetime.now(datetime.timezone.utc)), boundary)
+
+
+# Холодный путь сообщения одним запросом: завести пользователя и забрать счётчик, подписку,
+# резюме и последние реплики. Реплики отдаются массивами, чтобы уложиться в одну строку.
+USER_STATE = """
+CREATE OR REPLACE FUNCTION load_user_state(p_user_id BIGINT, p_limit INTEGER)
+RETURNS TABLE (
+    created BOOLEAN,
+    requests_today INTEGER,
+    requests_date DATE,
+    plan TEXT,
+    expires_at TIMESTAMPTZ,
+    summary TEXT,
+    summarized_until TIMESTAMPTZ,
+    roles TEXT[],
+    contents TEXT[],
+    created_ats TIMESTAMPTZ[]
+)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    inserted INTEGER;
+BEGIN
+    INSERT INTO users (user_id, requests_today) VALUES (p_user_id, 0) ON CONFLICT (user_id) DO NOTHING;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    RETURN QUERY
+    SELECT
+        inserted > 0,
+        u.requests_today,
+        u.requests_date,
+        s.plan,
+        s.expires_at,
+        ds.summary,
+        ds.summarized_until,
+        COALESCE(h.roles, '{}'),
+        COALESCE(h.contents, '{}'),
+        COALESCE(h.created_ats, '{}')
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT sub.plan, sub.expires_at FROM subscriptions sub
+        WHERE sub.user_id = p_user_id AND sub.status = 'active' AND sub.expires_at > NOW()
+        ORDER BY sub.expires_at DESC
+        LIMIT 1
+    ) s ON TRUE
+    LEFT JOIN dialog_summary ds ON ds.user_id = p_user_id
+    CROSS JOIN LATERAL (
+        SELECT
+            array_agg(t.role ORDER BY t.created_at) AS roles,
+            array_agg(t.content ORDER BY t.created_at) AS contents,
+            array_agg(t.created_at ORDER BY t.created_at) AS created_ats
+        FROM (
+            SELECT d.role, d.content, d.created_at FROM dialog_history d
+            WHERE d.user_id = p_user_id
+            ORDER BY d.created_at DESC
+            LIMIT p_limit
+        ) t
+    ) h
+    WHERE u.user_id = p_user_id;
+END
+$$;
+"""
+
+
+# (версия, описание, SQL или функция от соединения, в транзакции ли)
+MIGRATIONS = [
+    (1, "baseline schema", BASELINE, True),
+    (2, "dialog_history (user_id, created_at DESC) index", history_index, False),
+    (3, "partition dialog_history by month", partition_history, False),
+    (4, "load_user_state function", USER_STATE, True),
+]
+
+
+async def migrate(dsn):
+    # Отдельное соединение без command_timeout пула: CREATE INDEX CONCURRENTLY, дозаполнение
+    # и VALIDATE на большой таблице идут минутами, а вторая реплика столько же ждёт блокировку
+    connection = await asyncpg.connect(dsn)
+    try:
+        await connection.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK)
+        try:
+            await connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+                """
+            )
+            applied = {row["version"] for row in await connection.fetch("SELECT version FROM schema_migrations")}
+            for version, description, step, transactional in MIGRATIONS:
+                if version in applied:
+                    continue
+                logging.info("Applying migration %s: %s", version, description)
+                if transactional:
+                    async with connection.transaction():
+                        await _run(connection, step)
+                        await _mark(connection, version, description)
+                else:
+                    await _run(connection, step)
+                    await _mark(connection, version, description)
+        finally:
+            await connection.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK)
+    finally:
+        await connection.close()
+
+
+async def _run(connection, step):
+    if callable(step):
+        await step(connection)
+    else:
+        await connection.execute(step)
+
+
+async def _mark(connection, version, description):
+    await connection.execute(
+        "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)", version, description
+    )
+
+
+# ------- Обслуживание секций dialog_history --------
+def _bound(expr, keyword):
+    m = re.search(keyword + r" \('([^']+)'\)", expr)
+    return datetime.datetime.fromisoformat(m.group(1)) if m else None
+
+
+async def list_partitions(connection):
+    # [(имя, нижняя граница, верхняя граница)]; None снизу — MINVALUE, секция DEFAULT не входит
+    rows = await connection.fetch(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'dialog_history'::regclass
+        """
+    )
+    return [
+        (row["relname"], _bound(row["bound"], "FROM"), _bound(row["bound"], "TO"))
+        for row in rows
+        if row["bound"] != "DEFAULT"
+    ]
+
+
+async def ensure_partitions(connection, start, end):
+    # Месячные секции на [start, end); месяцы, которые уже покрыты (например, старой таблицей), пропускаем
+    partitions = await list_partitions(connection)
+    month = month_start(start)
+    while month < end:
+        upper = next_month(month)
+        overlaps = any((lo is None or lo < upper) and hi > month for _, lo, hi in partitions)
+        if not overlaps:
+            await connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF dialog_history "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')"
+            )
+        month = upper
+
+
+async def prune_partitions(connection, retention_days, archive):
+    if not retention_days:
+        return []
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=retention_days)
+    removed = []
+    for name, _, upper in await list_partitions(connection):
+        if upper > cutoff:
+            continue
+        await connection.execute(f"ALTER TABLE dialog_history DETACH PARTITION {name}")
+        if archive:
+            # Архив — отдельная схема: данные остаются, но из горячей таблицы ушли
+            await connection.execute("CREATE SCHEMA IF NOT EXISTS archive")
+            await connection.execute(f"ALTER TABLE {name} SET SCHEMA archive")
+        else:
+            await connection.execute(f"DROP TABLE {name}")
+        removed.append(name)
+    return removed
+
+
+class HistoryMaintenance:
+    def __init__(self, pool_getter, months_ahead, retention_days, archive, interval):
+        self.pool_getter = pool_getter
+        self.months_ahead = months_ahead
+        self.retention_days = retention_days
+        self.archive = archive
+        self.interval = interval
+        self._task = None
+
+    async def run_once(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        end = month_start(now)
+        for _ in range(self.months_ahead + 1):
+            end = next_month(end)
+        async with self.pool_getter().acquire() as connection:
+            await ensure_partitions(connection, now, end)
+            removed = await prune_partitions(connection, self.retention_days, self.archive)
+        if removed:
+            logging.info("Dialog history partitions %s: %s", "archived" if self.archive else "dropped", removed)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Dialog history maintenance failed")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,136 @@
+import json
+import re
+import zipfile
+from io import BytesIO
+
+from aiogram.types import BufferedInputFile
+
+# Блок кода в markdown: ```язык ...\n код ```; незакрытый блок в конце ответа тоже считается
+FENCE = re.compile(r"```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)(?:```|\Z)", re.DOTALL)
+
+# Тег языка → расширение файла
+EXTENSIONS = {
+    "python": "py", "py": "py", "python3": "py",
+    "javascript": "js", "js": "js", "jsx": "jsx", "node": "js",
+    "typescript": "ts", "ts": "ts", "tsx": "tsx",
+    "html": "html", "css": "css", "scss": "scss",
+    "json": "json", "yaml": "yaml", "yml": "yaml", "toml": "toml", "xml": "xml", "ini": "ini",
+    "sql": "sql", "postgresql": "sql", "mysql": "sql",
+    "bash": "sh", "sh": "sh", "shell": "sh", "zsh": "sh", "console": "sh",
+    "powershell": "ps1", "ps1": "ps1", "bat": "bat", "cmd": "bat",
+    "java": "java", "kotlin": "kt", "kt": "kt", "scala": "scala",
+    "c": "c", "h": "h", "cpp": "cpp", "c++": "cpp", "cc": "cpp", "hpp": "hpp",
+    "csharp": "cs", "cs": "cs", "c#": "cs",
+    "go": "go", "golang": "go", "rust": "rs", "rs": "rs", "swift": "swift",
+    "php": "php", "ruby": "rb", "rb": "rb", "perl": "pl", "lua": "lua", "r": "r", "dart": "dart",
+    "markdown": "md", "md": "md", "text": "txt", "txt": "txt", "plaintext": "txt",
+    "dockerfile": "Dockerfile", "docker": "Dockerfile", "makefile": "Makefile", "make": "Makefile",
+}
+
+# Если тега нет — угадываем по содержимому, первое совпадение выигрывает
+SIGNATURES = [
+    ("sh", re.compile(r"\A#!.*\b(?:ba|z)?sh\b")),
+    ("py", re.compile(r"\A#!.*python")),
+    ("html", re.compile(r"\A\s*<(?:!DOCTYPE|html)", re.IGNORECASE)),
+    ("xml", re.compile(r"\A\s*<\?xml")),
+    ("cpp", re.compile(r"^\s*#include\s*<(?:iostream|vector|string|map|algorithm)>", re.MULTILINE)),
+    ("c", re.compile(r"^\s*#include\s*[<\"]", re.MULTILINE)),
+    ("go", re.compile(r"^\s*package\s+\w+\s*$", re.MULTILINE)),
+    ("java", re.compile(r"^\s*public\s+(?:final\s+)?class\s+\w+", re.MULTILINE)),
+    ("py", re.compile(r"^\s*(?:def \w+\(|class \w+.*:\s*$|import \w+|from [\w.]+ import )", re.MULTILINE)),
+    ("sql", re.compile(r"^\s*(?:SELECT|INSERT|UPDATE|DELETE|CREATE|ALTER|WITH)\b", re.MULTILINE | re.IGNORECASE)),
+    ("js", re.compile(r"^\s*(?:function\s+\w+|const |let |export |import .* from ['\"])", re.MULTILINE)),
+    ("css", re.compile(r"^[\w.#:\s,>-]+\{\s*$", re.MULTILINE)),
+]
+
+# Имя файла в комментарии первой строки («# app.py», «// file: src/index.js») или в строке перед блоком
+FILENAME = r"((?:[\w-]+/)*[\w.-]*\w\.[A-Za-z0-9]{1,10}|Dockerfile|Makefile)"
+HEADER_NAME = re.compile(r"\A\s*(?:#|//|--|;|<!--|/\*)\s*(?:file(?:name)?\s*:\s*)?" + FILENAME + r"\s*(?:-->|\*/)?\s*$", re.IGNORECASE)
+LEAD_NAME = re.compile(r"[`*]{1,3}" + FILENAME + r"[`*]{1,3}\s*:?\s*\Z")
+# Первое определение — запасной вариант для имени
+DEFINITION = re.compile(r"^\s*(?:async\s+)?(?:def|class|function|func|fn|struct|interface)\s+([A-Za-z_]\w*)", re.MULTILINE)
+
+ARCHIVE_NAME = "code.zip"
+
+
+def detect_extension(language, code):
+    ext = EXTENSIONS.get(language.lower())
+    if ext:
+        return ext
+    for ext, pattern in SIGNATURES:
+        if pattern.search(code):
+            return ext
+    try:
+        json.loads(code)
+        return "json"
+    except ValueError:
+        return "txt"
+
+
+def _snake(name):
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", name).lower()
+
+
+def _filename(code, lead, ext, index):
+    first = code.split("\n", 1)[0]
+    m = HEADER_NAME.match(first) or LEAD_NAME.search(lead)
+    if m:
+        # Только имя, без каталогов: в архиве всё лежит плоско, а «../» нам не нужны
+        return m.group(1).rsplit("/", 1)[-1]
+    if ext in ("Dockerfile", "Makefile"):
+        return ext
+    m = DEFINITION.search(code)
+    stem = _snake(m.group(1)) if m else ("main" if index == 0 else f"part_{index + 1}")
+    return f"{stem}.{ext}"
+
+
+def split_answer(answer):
+    # [(имя файла, код)] и текст ответа без блоков кода (на их месте — ссылки на файлы)
+    files = []
+    prose = []
+    taken = set()
+    pos = 0
+    for index, m in enumerate(FENCE.finditer(answer)):
+        lead = answer[pos:m.start()]
+        code = m.group(2).rstrip() + "\n"
+        name = _filename(code, lead.rstrip().rsplit("\n", 1)[-1], detect_extension(m.group(1), code), index)
+        name = _unique(name, taken)
+        files.append((name, code))
+        prose.append(lead)
+        prose.append(f"📎 {name}")
+        pos = m.end()
+    if not files:
+        # Ответ целиком — код без разметки
+        return [(_filename(answer, "", detect_extension("", answer), 0), answer)], ""
+    prose.append(answer[pos:])
+    text = "".join(prose).strip()
+    # Одни ссылки на файлы без пояснений отдельным сообщением не шлём
+    if not "".join(prose[0::2]).strip():
+        text = ""
+    return files, text
+
+
+def _unique(name, taken):
+    # taken — уже занятые имена в нижнем регистре; суффикс растёт, пока имя не станет свободным,
+    # иначе «a.py», «a.py», «a_2.py» дали бы два «a_2.py»
+    stem, dot, ext = name.rpartition(".")
+    candidate = name
+    count = 1
+    while candidate.lower() in taken:
+        count += 1
+        candidate = f"{stem}_{count}.{ext}" if dot else f"{name}_{count}"
+    taken.add(candidate.lower())
+    return candidate
+
+
+def package(answer):
+    # Всё в памяти: один файл как есть, несколько — zip-архивом
+    files, prose = split_answer(answer)
+    if len(files) == 1:
+        name, code = files[0]
+        return BufferedInputFile(code.encode("utf-8"), name), prose
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, code in files:
+            archive.writestr(name, code)
+    return BufferedInputFile(buffer.getvalue(), ARCHIVE_NAME), prose
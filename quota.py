@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import logging
+
+
+def today():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+class QuotaEngine:
+    # Счётчики запросов живут в памяти, в users.requests_today уходят пачкой дельт.
+    # Сброс по дате ленивый: счётчик за вчера просто считается нулём.
+    def __init__(self, db, entitlements, free_limit, paid_limit, flush_interval, unlimited=()):
+        self.db = db
+        self.entitlements = entitlements
+        self.free_limit = free_limit
+        self.paid_limit = paid_limit
+        self.flush_interval = flush_interval
+        self.unlimited = set(unlimited)
+        self._counters = {}
+        self._deltas = {}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def consume(self, user_id):
+        if user_id in self.unlimited:
+            return True
+        day = today()
+        limit = await self._limit(user_id)
+        counter = self._counters.get(user_id)
+        if counter is None or counter[0] != day:
+            counter = await self._load(user_id, day)
+        # Проверка и инкремент без await между ними — атомарны в пределах процесса
+        if limit and counter[1] >= limit:
+            return False
+        counter[1] += 1
+        key = (user_id, day)
+        self._deltas[key] = self._deltas.get(key, 0) + 1
+        return True
+
+    async def _limit(self, user_id):
+        sub = await self.entitlements.get(user_id)
+        return self.paid_limit if sub is not None else self.free_limit
+
+    def loaded(self, user_id):
+        counter = self._counters.get(user_id)
+        return user_id in self.unlimited or (counter is not None and counter[0] == today())
+
+    async def _load(self, user_id, day):
+        row = await self.db.get_request_counter(user_id)
+        return self.seed(user_id, row, day)
+
+    def seed(self, user_id, row, day=None):
+        day = day or today()
+        count = row["requests_today"] if row and row["requests_date"] == day else 0
+        counter = self._counters.get(user_id)
+        if counter is not None and counter[0] == day:
+            # Пока ждали БД, счётчик уже загрузил параллельный запрос
+            return counter
+        counter = [day, count]
+        self._counters[user_id] = counter
+        return counter
+
+    def _sweep(self):
+        day = today()
+        for user_id in [uid for uid, (d, _) in self._counters.items() if d != day]:
+            del self._counters[user_id]
+
+    async def flush(self):
+        if not self._deltas:
+            return
+        deltas, self._deltas = self._deltas, {}
+        rows = [(user_id, delta, day) for (user_id, day), delta in deltas.items()]
+        try:
+            await self.db.add_request_counts(rows)
+        except Exception:
+            logging.exception("Failed to flush %s quota counters, will retry", len(rows))
+            for key, delta in deltas.items():
+                self._deltas[key] = self._deltas.get(key, 0) + delta
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._sweep()
@@ -0,0 +1,282 @@
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from itertools import count
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+import metrics
+
+# Приоритеты исходящих запросов: меньше — раньше
+INTERACTIVE = 0
+BULK = 1
+
+_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level):
+    # Всё, что отправляется внутри блока (и в созданных из него задачах), идёт с этим приоритетом
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now):
+        # Через сколько секунд можно будет взять токен (0 — прямо сейчас)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def idle(self, now):
+        return now >= self.blocked_until and self.delay(now) == 0 and self.tokens >= self.burst
+
+
+class _Pending:
+    __slots__ = ("level", "seq", "chat_id", "method", "granted", "done", "enqueued")
+
+    def __init__(self, level, seq, chat_id, method):
+        self.level = level
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        loop = asyncio.get_running_loop()
+        self.granted = loop.create_future()
+        self.done = loop.create_future()
+        self.enqueued = time.monotonic()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    # Все запросы к Bot API, адресованные чату, проходят через общую очередь:
+    # глобальный лимит и лимит на чат (token bucket), интерактивные ответы раньше рассылки,
+    # 429 retry_after выжидается здесь же, а ожидающие правки одного сообщения схлопываются в последнюю.
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate, bulk_rate, max_retries):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._bulk = TokenBucket(bulk_rate, bulk_rate)
+        self._chats = {}
+        self._queue = []
+        self._edits = {}
+        self._seq = count()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._swept = time.monotonic()
+
+    def start(self):
+        self._task = asyncio.create_task(self._dispatcher())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or self._task is None:
+            return await make_request(bot, method)
+
+        key = self._edit_key(method)
+        if key is not None:
+            queued = self._edits.get(key)
+            if queued is not None and not queued.granted.done():
+                # Правка ещё не ушла — просто подменяем текст на более свежий
+                queued.method = method
+                return await asyncio.shield(queued.done)
+
+        entry = _Pending(_priority.get(), next(self._seq), chat_id, method)
+        try:
+            for attempt in range(self.max_retries + 1):
+                self._enqueue(entry, key)
+                await entry.granted
+                metrics.SEND_WAIT_SECONDS.labels(self._level_name(entry.level)).observe(
+                    time.monotonic() - entry.enqueued
+                )
+                try:
+                    result = await make_request(bot, entry.method)
+                except TelegramRetryAfter as e:
+                    metrics.SEND_RETRIES.inc()
+                    if attempt == self.max_retries:
+                        raise
+                    self._penalize(chat_id, e.retry_after)
+                    entry.granted = asyncio.get_running_loop().create_future()
+                    continue
+                entry.done.set_result(result)
+                return result
+        except BaseException as e:
+            if not entry.done.done():
+                if isinstance(e, asyncio.CancelledError):
+                    entry.done.cancel()
+                else:
+                    entry.done.set_exception(e)
+                    # Исключение заберут схлопнутые правки; если их нет — не ругаться в лог
+                    entry.done.exception()
+            raise
+        finally:
+            if key is not None and self._edits.get(key) is entry:
+                del self._edits[key]
+
+    @staticmethod
+    def _edit_key(method):
+        if isinstance(method, EditMessageText) and method.message_id is not None:
+            return method.chat_id, method.message_id
+        return None
+
+    @staticmethod
+    def _level_name(level):
+        return "interactive" if level == INTERACTIVE else "bulk"
+
+    def _enqueue(self, entry, key):
+        self._queue.append(entry)
+        if key is not None:
+            queued = self._edits.get(key)
+            if queued is None or queued.granted.done():
+                self._edits[key] = entry
+        self._wake.set()
+
+    def _penalize(self, chat_id, retry_after):
+        # Telegram не говорит, какой лимит сработал, поэтому притормаживаем и чат, и всех
+        until = time.monotonic() + retry_after
+        self._chat_bucket(chat_id).block(until)
+        if retry_after > 1:
+            self._global.block(time.monotonic() + 1)
+        logging.warning("Telegram flood limit for chat %s, retry after %ss", chat_id, retry_after)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # У групп (отрицательный id) лимит строже, чем у личных чатов
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _grant(self):
+        # Выдаём разрешения в порядке приоритета; возвращает, сколько ждать до следующей попытки
+        now = time.monotonic()
+        self._queue = [entry for entry in self._queue if not entry.granted.done()]
+        self._queue.sort(key=lambda entry: (entry.level, entry.seq))
+        granted = set()
+        soonest = None
+        for entry in self._queue:
+            wait = self._global.delay(now)
+            if wait:
+                soonest = wait if soonest is None else min(soonest, wait)
+                break
+            bucket = self._chat_bucket(entry.chat_id)
+            wait = bucket.delay(now)
+            if not wait and entry.level == BULK:
+                wait = self._bulk.delay(now)
+            if wait:
+                soonest = wait if soonest is None else min(soonest, wait)
+                continue
+            self._global.take()
+            bucket.take()
+            if entry.level == BULK:
+                self._bulk.take()
+            entry.granted.set_result(None)
+            granted.add(id(entry))
+        self._queue = [entry for entry in self._queue if id(entry) not in granted]
+        return soonest
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept < 60:
+            return
+        self._swept = now
+        for chat_id in [c for c, bucket in self._chats.items() if bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    async def _dispatcher(self):
+        while True:
+            self._wake.clear()
+            wait = self._grant()
+            self._sweep()
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Broadcast:
+    # Рассылка по всем пользователям: получатели читаются из БД страницами по user_id,
+    # отправка идёт с приоритетом BULK и не задерживает ответы живым пользователям
+    def __init__(self, bot, db, page_size, concurrency):
+        self.bot = bot
+        self.db = db
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, text, on_done):
+        if self.running:
+            return False
+        with priority(BULK):
+            self._task = asyncio.create_task(self._run(text, on_done))
+        return True
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, text, on_done):
+        sent = failed = 0
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id):
+            nonlocal sent, failed
+            async with slots:
+                try:
+                    await self.bot.send_message(user_id, text)
+                    sent += 1
+                except Exception:
+                    # Заблокировавшие бота, удалённые аккаунты и т.п. — просто считаем
+                    failed += 1
+
+        after = 0
+        try:
+            while True:
+                user_ids = await self.db.get_user_ids(after, self.page_size)
+                if not user_ids:
+                    break
+                await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+                after = user_ids[-1]
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Broadcast stopped after %s messages", sent)
+        await on_done(sent, failed)
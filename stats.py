@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import logging
+
+
+def today():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+class Stats:
+    # Счётчики для админки ведутся на лету; полный пересчёт — редко и в фоне, чтобы учесть
+    # истёкшие подписки и пользователей, добавленных другими процессами
+    def __init__(self, db, refresh_interval, flush_interval):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+        self.users = 0
+        self.plans = {}
+        self._day = today()
+        self._active = set()
+        self._messages = 0
+        self._pending_messages = 0
+        self._dirty = False
+        self._closed = None
+        self._tasks = []
+
+    async def start(self):
+        await self.refresh()
+        self._tasks = [
+            asyncio.create_task(self._every(self.refresh_interval, self.refresh)),
+            asyncio.create_task(self._every(self.flush_interval, self.flush)),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def refresh(self):
+        users, plans = await self.db.get_stats()
+        self.users = users
+        self.plans = plans
+
+    def user_added(self):
+        self.users += 1
+
+    def subscription_added(self, user_id, plan):
+        self.plans[plan] = self.plans.get(plan, 0) + 1
+
+    def seen(self, user_id):
+        self._rollover()
+        self._messages += 1
+        self._pending_messages += 1
+        self._active.add(user_id)
+        self._dirty = True
+
+    @property
+    def active_today(self):
+        self._rollover()
+        return len(self._active)
+
+    @property
+    def messages_today(self):
+        self._rollover()
+        return self._messages
+
+    def _rollover(self):
+        day = today()
+        if day != self._day:
+            # Вчерашние цифры уходят в БД при следующем flush, но день у них свой
+            self._closed = (self._day, len(self._active), self._pending_messages)
+            self._day = day
+            self._active = set()
+            self._messages = 0
+            self._pending_messages = 0
+
+    async def flush(self):
+        self._rollover()
+        rows = []
+        if self._closed is not None:
+            rows.append(self._closed)
+            self._closed = None
+        if self._dirty:
+            rows.append((self._day, len(self._active), self._pending_messages))
+            self._pending_messages = 0
+            self._dirty = False
+        if not rows:
+            return
+        try:
+            await self.db.add_daily_stats(rows)
+        except Exception:
+            logging.exception("Failed to flush daily stats")
+            for day, _, messages in rows:
+                if day == self._day:
+                    self._pending_messages += messages
+                    self._dirty = True
+
+    async def _every(self, interval, func):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func()
+            except Exception:
+                logging.exception("Stats task %s failed", func.__name__)
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from ai_client import openai_client, model_slot
+
+TELEGRAM_TEXT_LIMIT = 4096
+CURSOR = " ▌"
+
+
+class StreamingReply:
+    # Копит токены и редактирует сообщение-заглушку не чаще раза в interval секунд
+    def __init__(self, placeholder, interval, min_delta, is_file):
+        self.placeholder = placeholder
+        self.interval = interval
+        self.min_delta = min_delta
+        self.is_file = is_file
+        self.text = ""
+        self.as_file = False
+        self._shown = 0
+        self._dirty = asyncio.Event()
+        self._done = False
+        self._task = asyncio.create_task(self._flusher())
+
+    def feed(self, delta):
+        self.text += delta
+        if self.as_file:
+            return
+        if self.is_file(self.text):
+            # Похоже на код — дальше не показываем, ответ уйдёт документом
+            self.as_file = True
+        if self.as_file or len(self.text) - self._shown >= self.min_delta:
+            self._dirty.set()
+
+    async def finish(self):
+        self._done = True
+        self._dirty.set()
+        try:
+            await self._task
+        except Exception:
+            # Промежуточные правки — косметика: готовый ответ из-за них не теряем
+            logging.exception("Streaming preview failed")
+
+    async def _flusher(self):
+        while not self._done:
+            await self._dirty.wait()
+            self._dirty.clear()
+            if self._done:
+                break
+            if self.as_file:
+                await self._edit("📎 Готовлю файл…")
+                break
+            if len(self.text) + len(CURSOR) > TELEGRAM_TEXT_LIMIT:
+                # Дальше не влезет в одно сообщение — остаток допишем после генерации
+                break
+            await self._edit(self.text + CURSOR)
+            self._shown = len(self.text)
+            await asyncio.sleep(self.interval)
+
+    async def _edit(self, text):
+        try:
+            await self.placeholder.edit_text(text, parse_mode=None)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.warning("Streaming edit failed: %s", e)
+        except Exception as e:
+            # Сеть, 429 после исчерпанных повторов планировщика и т.п. — пропускаем правку, поток не роняем
+            logging.warning("Streaming edit failed: %r", e)
+
+
+async def stream_completion(placeholder, messages, is_file, interval, min_delta, model="gpt-4o"):
+    reply = StreamingReply(placeholder, interval, min_delta, is_file)
+    try:
+        async with model_slot(model):
+            stream = await openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    reply.feed(chunk.choices[0].delta.content)
+    finally:
+        await reply.finish()
+    return reply.text, reply.as_file
+
+
+async def finalize_text(placeholder, message, text, reply_markup):
+    # Первая часть — в заглушку, всё, что не влезло в лимит Telegram, — отдельными сообщениями
+    parts = [text[i:i + TELEGRAM_TEXT_LIMIT] for i in range(0, len(text), TELEGRAM_TEXT_LIMIT)] or [""]
+    try:
+        await placeholder.edit_text(parts[0])
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            pass
+        else:
+            # Модель могла вернуть невалидный HTML — показываем как есть
+            await placeholder.edit_text(parts[0], parse_mode=None)
+    for part in parts[1:]:
+        await message.answer(part, reply_markup=reply_markup)
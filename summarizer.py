@@ -0,0 +1,120 @@
+import asyncio
+
+from ai_client import openai_client, model_slot
+from tokens import count_tokens
+
+SYSTEM_PROMPT = "Ты профессиональный ассистент, делаешь структурированные краткие резюме по тексту документа, не придумываешь фактов."
+FINAL_PROMPT = "Сделай краткое, структурированное резюме по этому тексту (выдели основные моменты, сохрани факты, пиши лаконично):\n\n{text}"
+MAP_PROMPT = (
+    "Это часть {index} из {total} большого документа. Выпиши её основные моменты: факты, цифры, даты, имена, "
+    "выводы. Пиши лаконично, без вступлений:\n\n{text}"
+)
+REDUCE_PROMPT = (
+    "Ниже — резюме последовательных частей одного документа. Объедини их в одно связное резюме, "
+    "убери повторы, сохрани факты и порядок изложения:\n\n{text}"
+)
+
+
+def split_chunks(text, chunk_tokens):
+    # Режем по абзацам, слишком длинные абзацы — по символам
+    chunks = []
+    current = []
+    used = 0
+    for paragraph in text.split("\n"):
+        cost = count_tokens(paragraph) + 1
+        if cost > chunk_tokens:
+            step = max(chunk_tokens * 3, 1)
+            pieces = [paragraph[i:i + step] for i in range(0, len(paragraph), step)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            cost = count_tokens(piece) + 1
+            if current and used + cost > chunk_tokens:
+                chunks.append("\n".join(current))
+                current = []
+                used = 0
+            current.append(piece)
+            used += cost
+    if current:
+        chunks.append("\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+
+class DocumentSummarizer:
+    def __init__(self, model, chunk_tokens, max_chunks, fanout, concurrency):
+        self.model = model
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.fanout = fanout
+        # Общий лимит на все документы, чтобы один огромный файл не съел слоты модели
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def _complete(self, prompt, max_tokens):
+        async with self._slots:
+            async with model_slot(self.model):
+                response = await openai_client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt},
+                    ],
+                    max_tokens=max_tokens,
+                )
+        return response.choices[0].message.content.strip()
+
+    async def summarize(self, text, progress=None):
+        chunks = split_chunks(text, self.chunk_tokens)
+        truncated = len(chunks) > self.max_chunks
+        chunks = chunks[:self.max_chunks]
+        if len(chunks) <= 1:
+            return await self._complete(FINAL_PROMPT.format(text=text), 600), truncated
+
+        # Map: части документа параллельно, но не больше fanout одновременно на один файл
+        fanout = asyncio.Semaphore(self.fanout)
+        done = 0
+        total = len(chunks)
+
+        async def map_chunk(index, chunk):
+            nonlocal done
+            async with fanout:
+                summary = await self._complete(
+                    MAP_PROMPT.format(index=index + 1, total=total, text=chunk), 400
+                )
+            done += 1
+            if progress:
+                await progress(done, total)
+            return summary
+
+        parts = await asyncio.gather(*[map_chunk(i, c) for i, c in enumerate(chunks)])
+
+        # Reduce: склеиваем резюме группами, пока всё не влезет в один запрос
+        while count_tokens("\n\n".join(parts)) > self.chunk_tokens and len(parts) > 1:
+            groups = self._group(parts)
+            parts = await asyncio.gather(*[
+                self._bounded(fanout, REDUCE_PROMPT.format(text="\n\n".join(g)), 600) for g in groups
+            ])
+        return await self._complete(FINAL_PROMPT.format(text="\n\n".join(parts)), 600), truncated
+
+    async def _bounded(self, fanout, prompt, max_tokens):
+        async with fanout:
+            return await self._complete(prompt, max_tokens)
+
+    def _group(self, parts):
+        groups = []
+        current = []
+        used = 0
+        for part in parts:
+            cost = count_tokens(part)
+            if current and (used + cost > self.chunk_tokens or len(current) >= 8):
+                groups.append(current)
+                current = []
+                used = 0
+            current.append(part)
+            used += cost
+        if current:
+            groups.append(current)
+        if len(groups) == 1 and len(parts) > 1:
+            # Гарантируем сходимость, даже если одно резюме само больше бюджета
+            middle = len(parts) // 2
+            groups = [parts[:middle], parts[middle:]]
+        return groups
@@ -0,0 +1,5 @@
+import os
+
+# config.py читает обязательные переменные при импорте — для модулей, что его тянут, хватит заглушек
+os.environ.setdefault("OWNER_CHAT_ID", "0")
+os.environ.setdefault("OPENAI_API_KEY", "test")
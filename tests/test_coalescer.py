@@ -0,0 +1,192 @@
+import asyncio
+from types import SimpleNamespace
+
+import coalescer
+from coalescer import Coalescer
+
+WINDOW = 0.05
+
+
+def make_message(message_id, chat_id=1, user_id=1):
+    return SimpleNamespace(message_id=message_id, chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=user_id))
+
+
+class Recorder:
+    # Обработчик хода: запоминает вызовы и по желанию «думает» до отмены
+    def __init__(self, block=False, record=False, settle=False, charge=False):
+        self.block = block
+        self.record = record
+        self.settle = settle
+        self.charge = charge
+        self.calls = []
+        self.cancelled = []
+        self.started = asyncio.Event()
+
+    async def __call__(self, message, text):
+        self.calls.append((message.message_id, text, coalescer.paid()))
+        if self.charge and not coalescer.paid():
+            coalescer.charged()
+        if self.record:
+            coalescer.record()
+        if self.settle:
+            coalescer.settle()
+        self.started.set()
+        if self.block and len(self.calls) == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled.append(message.message_id)
+                raise
+
+
+def test_rapid_messages_become_one_turn():
+    async def scenario():
+        handler = Recorder()
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "привет")
+        await asyncio.sleep(WINDOW / 5)
+        turns.add(make_message(2), "как дела?")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.calls
+
+    # Отвечаем на последнее сообщение пачки, тексты склеены по порядку
+    assert asyncio.run(scenario()) == [(2, "привет\nкак дела?", False)]
+
+
+def test_pause_longer_than_window_starts_new_turn():
+    async def scenario():
+        handler = Recorder()
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "раз")
+        await asyncio.sleep(WINDOW * 3)
+        turns.add(make_message(2), "два")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.calls
+
+    assert asyncio.run(scenario()) == [(1, "раз", False), (2, "два", False)]
+
+
+def test_max_wait_caps_debounce():
+    async def scenario():
+        handler = Recorder()
+        turns = Coalescer(handler, window=WINDOW, max_wait=WINDOW * 2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        flushed_at = None
+        # Пишем чаще, чем window: без max_wait ход так и не ушёл бы
+        for i in range(20):
+            turns.add(make_message(i), str(i))
+            await asyncio.sleep(WINDOW / 2)
+            if handler.calls and flushed_at is None:
+                flushed_at = loop.time() - start
+        await turns.stop()
+        return flushed_at, len(handler.calls)
+
+    flushed_at, calls = asyncio.run(scenario())
+    assert flushed_at is not None and flushed_at < WINDOW * 4
+    assert calls > 1
+
+
+def test_new_message_cancels_running_turn_and_carries_its_text():
+    async def scenario():
+        handler = Recorder(block=True)
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "напиши функцию")
+        await asyncio.wait_for(handler.started.wait(), 1)
+        turns.add(make_message(2), "на питоне")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.cancelled, handler.calls[-1]
+
+    # Реплика в историю не попала — её текст уходит в новый ход
+    assert asyncio.run(scenario()) == ([1], (2, "напиши функцию\nна питоне", False))
+
+
+def test_recorded_text_is_not_carried_twice():
+    async def scenario():
+        handler = Recorder(block=True, record=True)
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "напиши функцию")
+        await asyncio.wait_for(handler.started.wait(), 1)
+        turns.add(make_message(2), "на питоне")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.cancelled, handler.calls[-1]
+
+    # Первая реплика уже в истории — модель увидит её оттуда
+    assert asyncio.run(scenario()) == ([1], (2, "на питоне", False))
+
+
+def test_settled_turn_is_not_cancelled():
+    async def scenario():
+        handler = Recorder(block=True, settle=True)
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "вопрос")
+        await asyncio.wait_for(handler.started.wait(), 1)
+        turns.add(make_message(2), "ещё вопрос")
+        await asyncio.sleep(WINDOW * 3)
+        cancelled = list(handler.cancelled)
+        await turns.stop(timeout=0)
+        return cancelled, handler.calls[-1]
+
+    assert asyncio.run(scenario()) == ([], (2, "ещё вопрос", False))
+
+
+def test_cancelled_turn_payment_is_carried_over():
+    async def scenario():
+        handler = Recorder(block=True, charge=True)
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "раз")
+        await asyncio.wait_for(handler.started.wait(), 1)
+        turns.add(make_message(2), "два")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.calls
+
+    # Первый ход списал запрос и был отменён — второй ход уже оплачен
+    assert asyncio.run(scenario()) == [(1, "раз", False), (2, "раз\nдва", True)]
+
+
+def test_prepaid_fragment_marks_turn_paid():
+    async def scenario():
+        handler = Recorder()
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "текст")
+        turns.add(make_message(2), "расшифровка голосового", paid=True)
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return handler.calls
+
+    assert asyncio.run(scenario()) == [(2, "текст\nрасшифровка голосового", True)]
+
+
+def test_command_flushes_pending_batch_and_runs_alone():
+    async def scenario():
+        handler = Recorder()
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "привет")
+        turns.add(make_message(2), "нарисуй кота", alone=True)
+        turns.add(make_message(3), "спасибо")
+        await asyncio.sleep(WINDOW * 3)
+        await turns.stop()
+        return sorted(handler.calls)
+
+    # Ни команда к тексту, ни текст к команде не приклеились
+    assert asyncio.run(scenario()) == [(1, "привет", False), (2, "нарисуй кота", False), (3, "спасибо", False)]
+
+
+def test_command_is_not_cancelled_by_next_message():
+    async def scenario():
+        handler = Recorder(block=True)
+        turns = Coalescer(handler, window=WINDOW, max_wait=1)
+        turns.add(make_message(1), "нарисуй кота", alone=True)
+        await asyncio.wait_for(handler.started.wait(), 1)
+        turns.add(make_message(2), "спасибо")
+        await asyncio.sleep(WINDOW * 3)
+        cancelled = list(handler.cancelled)
+        await turns.stop(timeout=0)
+        return cancelled, handler.calls[-1]
+
+    assert asyncio.run(scenario()) == ([], (2, "спасибо", False))
@@ -0,0 +1,69 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import context
+from context import ContextBuilder
+
+
+class FakeOpenAI:
+    # Резюме — список реплик, попавших в запрос: по нему видно, что и в каком порядке свёрнуто
+    def __init__(self):
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, **kwargs):
+        prompt = messages[-1]["content"]
+        self.requests.append(prompt)
+        dialog = prompt.split("Новые реплики:\n", 1)[1]
+        content = ",".join(line.split(": ", 1)[1][:3] for line in dialog.split("\n"))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeDb:
+    def __init__(self):
+        self.saved = []
+
+    async def save_summary(self, user_id, summary, until):
+        self.saved.append((summary, until))
+
+
+def make_turns(count, size):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        ("user", f"{i:03d}" + "x" * size, start + datetime.timedelta(minutes=i))
+        for i in range(count)
+    ]
+
+
+def fold(turns, budget, monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(context, "openai_client", fake)
+    db = FakeDb()
+    builder = ContextBuilder(
+        db, history=None, budget=budget, max_turns=16, fold_min_turns=1,
+        summary_model="gpt-4o-mini", summary_max_tokens=100, max_users=10,
+    )
+    asyncio.run(builder._fold(1, None, turns))
+    return fake.requests, db.saved, builder._summaries[1]
+
+
+def test_small_overflow_is_folded_in_one_pass(monkeypatch):
+    turns = make_turns(3, 10)
+    requests, saved, cached = fold(turns, budget=1000, monkeypatch=monkeypatch)
+    assert len(requests) == 1
+    assert saved == [("000,001,002", turns[-1][2])]
+    assert cached == saved[-1]
+
+
+def test_overflow_above_budget_is_folded_in_passes(monkeypatch):
+    turns = make_turns(10, 300)
+    requests, saved, cached = fold(turns, budget=400, monkeypatch=monkeypatch)
+    assert len(requests) > 1
+    # Каждая реплика свёрнута ровно один раз, по порядку, и отметка — на последней свёрнутой
+    folded = [part for summary, _ in saved for part in summary.split(",")]
+    assert folded == [f"{i:03d}" for i in range(10)]
+    assert saved[-1][1] == turns[-1][2]
+    for summary, until in saved:
+        assert until == turns[int(summary.split(",")[-1])][2]
+    assert cached == saved[-1]
@@ -0,0 +1,41 @@
+import io
+import zipfile
+
+import extractors
+
+
+def make_zip(files, encrypted=()):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, text in files:
+            archive.writestr(name, text)
+    data = bytearray(buffer.getvalue())
+    # Бит шифрования в локальном и центральном заголовках — ZipFile.open откажется читать без пароля
+    for name in encrypted:
+        local = data.find(b"PK\x03\x04")
+        while local != -1:
+            name_len = int.from_bytes(data[local + 26:local + 28], "little")
+            if data[local + 30:local + 30 + name_len] == name.encode():
+                data[local + 6] |= 1
+            local = data.find(b"PK\x03\x04", local + 4)
+        central = data.find(b"PK\x01\x02")
+        while central != -1:
+            name_len = int.from_bytes(data[central + 28:central + 30], "little")
+            if data[central + 46:central + 46 + name_len] == name.encode():
+                data[central + 8] |= 1
+            central = data.find(b"PK\x01\x02", central + 4)
+    return bytes(data)
+
+
+def test_zip_members_are_extracted():
+    text = extractors.extract_text("x.zip", make_zip([("a.txt", "первый"), ("b.txt", "второй")]), 10000)
+    assert "--- a.txt ---\nпервый" in text
+    assert "--- b.txt ---\nвторой" in text
+
+
+def test_unreadable_member_does_not_fail_archive():
+    data = make_zip([("secret.txt", "скрыто"), ("open.txt", "видно")], encrypted=["secret.txt"])
+    text = extractors.extract_text("x.zip", data, 10000)
+    assert "secret.txt (не удалось прочитать:" in text
+    assert "скрыто" not in text
+    assert "--- open.txt ---\nвидно" in text
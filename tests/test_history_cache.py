@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+
+from history_cache import HistoryCache
+
+
+class FakeDb:
+    # dialog_history в памяти; fetch_turns может «зависнуть» до или после чтения строк
+    def __init__(self):
+        self.rows = []
+        self.batches = []
+        self.down = False
+        self.fetch_started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.read_before_wait = False
+
+    async def add_messages(self, rows):
+        self.batches.append(len(rows))
+        if self.down:
+            raise ConnectionError("database is down")
+        self.rows.extend(rows)
+
+    async def fetch_turns(self, user_id, limit=16):
+        snapshot = self._select(user_id, limit)
+        self.fetch_started.set()
+        await self.release.wait()
+        return snapshot if self.read_before_wait else self._select(user_id, limit)
+
+    def _select(self, user_id, limit):
+        rows = [
+            {"role": role, "content": content, "created_at": created_at}
+            for uid, role, content, created_at in self.rows
+            if uid == user_id
+        ]
+        return rows[-limit:]
+
+
+def make_cache(db, flush_batch=100, max_pending_bytes=1 << 20):
+    return HistoryCache(
+        db, max_turns=16, max_users=100, ttl=60, max_bytes=1 << 20, flush_interval=60,
+        flush_batch=flush_batch, max_pending_bytes=max_pending_bytes,
+    )
+
+
+async def load_with_flush_in_between(read_before_wait):
+    db = FakeDb()
+    db.read_before_wait = read_before_wait
+    cache = make_cache(db)
+    await cache.add(1, "user", "привет")
+    load = asyncio.create_task(cache.get_turns(1))
+    await db.fetch_started.wait()
+    # Фоновый flush коммитит реплику, пока загрузка истории ждёт БД
+    await cache.flush()
+    db.release.set()
+    return await load
+
+
+def test_turn_flushed_after_db_read_is_not_lost():
+    turns = asyncio.run(load_with_flush_in_between(read_before_wait=True))
+    assert [(role, content) for role, content, _ in turns] == [("user", "привет")]
+
+
+def test_turn_flushed_before_db_read_is_not_duplicated():
+    turns = asyncio.run(load_with_flush_in_between(read_before_wait=False))
+    assert [(role, content) for role, content, _ in turns] == [("user", "привет")]
+
+
+def test_turns_added_during_load_are_kept_in_order():
+    async def scenario():
+        db = FakeDb()
+        cache = make_cache(db)
+        old = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        db.rows.append((1, "user", "старое", old))
+        await cache.add(1, "user", "первое")
+        load = asyncio.create_task(cache.get_turns(1))
+        await db.fetch_started.wait()
+        await cache.add(1, "user", "второе")
+        db.release.set()
+        return await load
+
+    turns = asyncio.run(scenario())
+    assert [content for _, content, _ in turns] == ["старое", "первое", "второе"]
+
+
+def test_flush_writes_in_batches_of_flush_batch():
+    async def scenario():
+        db = FakeDb()
+        cache = make_cache(db, flush_batch=4)
+        for i in range(10):
+            await cache.add(1, "user", str(i))
+        await cache.flush()
+        return db.batches, [content for _, _, content, _ in db.rows]
+
+    batches, contents = asyncio.run(scenario())
+    assert batches == [4, 4, 2]
+    assert contents == [str(i) for i in range(10)]
+
+
+def test_pending_queue_is_capped_while_db_is_down():
+    async def scenario():
+        db = FakeDb()
+        db.down = True
+        cache = make_cache(db, flush_batch=4, max_pending_bytes=10)
+        # Каждая реплика — 2 байта: в очередь влезает 5 последних
+        for i in range(20):
+            await cache.add(1, "user", f"{i:02d}")
+            await cache.flush()
+        queued = [content for _, content, _ in cache.unflushed(1)]
+        db.down = False
+        await cache.flush()
+        return queued, max(db.batches), [content for _, _, content, _ in db.rows]
+
+    queued, largest, written = asyncio.run(scenario())
+    assert queued == ["15", "16", "17", "18", "19"]
+    assert largest <= 4
+    assert written == queued
@@ -0,0 +1,71 @@
+import io
+import zipfile
+
+import packager
+
+
+def test_fence_splits_code_from_prose():
+    files, prose = packager.split_answer("Вот код:\n```python\ndef hello_world():\n    pass\n```\nГотово.")
+    assert files == [("hello_world.py", "def hello_world():\n    pass\n")]
+    assert prose == "Вот код:\n📎 hello_world.py\nГотово."
+
+
+def test_unclosed_fence_at_end_is_a_block():
+    files, prose = packager.split_answer("```go\npackage main\n```\nИ ещё:\n```rust\nfn run() {}")
+    assert files == [("main.go", "package main\n"), ("run.rs", "fn run() {}\n")]
+    assert prose == "📎 main.go\nИ ещё:\n📎 run.rs"
+
+
+def test_links_without_prose_give_no_text():
+    _, prose = packager.split_answer("```js\nconst a = 1\n```")
+    assert prose == ""
+
+
+def test_answer_without_fences_is_one_file():
+    files, prose = packager.split_answer("def main():\n    pass\n")
+    assert files == [("main.py", "def main():\n    pass\n")]
+    assert prose == ""
+
+
+def test_language_tag_picks_extension():
+    assert packager.detect_extension("Python", "x = 1") == "py"
+    assert packager.detect_extension("typescript", "") == "ts"
+    assert packager.detect_extension("c++", "") == "cpp"
+    assert packager.detect_extension("Dockerfile", "FROM python") == "Dockerfile"
+
+
+def test_extension_is_guessed_from_code_without_tag():
+    assert packager.detect_extension("", "#!/bin/bash\necho hi") == "sh"
+    assert packager.detect_extension("", "#include <iostream>\nint main() {}") == "cpp"
+    assert packager.detect_extension("", "SELECT 1") == "sql"
+    assert packager.detect_extension("", '{"a": 1}') == "json"
+    assert packager.detect_extension("", "просто текст") == "txt"
+
+
+def test_filename_from_header_comment_or_lead_line():
+    files, _ = packager.split_answer("**app.py**:\n```python\nprint(1)\n```\n```js\n// file: src/index.js\nrun()\n```")
+    assert [name for name, _ in files] == ["app.py", "index.js"]
+
+
+def test_colliding_names_get_unused_suffixes():
+    answer = "".join(f"```python\n# {name}\nx = {i}\n```\n" for i, name in enumerate(["a.py", "a.py", "a_2.py", "A.py"]))
+    files, _ = packager.split_answer(answer)
+    names = [name for name, _ in files]
+    assert names == ["a.py", "a_2.py", "a_2_2.py", "A_3.py"]
+    assert len({name.lower() for name in names}) == len(names)
+
+
+def test_single_file_is_sent_as_is():
+    document, prose = packager.package("```python\ndef hello():\n    pass\n```")
+    assert document.filename == "hello.py"
+    assert document.data == b"def hello():\n    pass\n"
+    assert prose == ""
+
+
+def test_several_files_are_zipped():
+    document, prose = packager.package("Два файла:\n```python\n# a.py\nx = 1\n```\n```python\n# a.py\nx = 2\n```")
+    assert document.filename == packager.ARCHIVE_NAME
+    with zipfile.ZipFile(io.BytesIO(document.data)) as archive:
+        assert archive.namelist() == ["a.py", "a_2.py"]
+        assert archive.read("a_2.py") == b"# a.py\nx = 2\n"
+    assert prose == "Два файла:\n📎 a.py\n📎 a_2.py"
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+
+from sender import SendScheduler
+
+
+def make_scheduler(chat_rate=20, chat_burst=3, max_retries=2):
+    # Лимиты в 20 раз выше боевых, чтобы тест шёл доли секунды
+    return SendScheduler(
+        global_rate=1000, chat_rate=chat_rate, chat_burst=chat_burst, group_rate=chat_rate,
+        bulk_rate=1000, max_retries=max_retries,
+    )
+
+
+class FakeApi:
+    # Вместо сетевого запроса: запоминает, что и когда ушло
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}
+
+    async def __call__(self, bot, method):
+        self.sent.append((time.monotonic(), method))
+        retry_after = self.failures.pop(method.text, None)
+        if retry_after is not None:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=retry_after)
+        return method.text
+
+
+def test_burst_then_chat_rate():
+    async def scenario():
+        scheduler = make_scheduler(chat_rate=20, chat_burst=3)
+        api = FakeApi()
+        scheduler.start()
+        start = time.monotonic()
+        await asyncio.gather(
+            *(scheduler(api, None, SendMessage(chat_id=1, text=str(i))) for i in range(7)),
+            scheduler(api, None, SendMessage(chat_id=2, text="other")),
+        )
+        await scheduler.stop()
+        return start, api.sent
+
+    start, sent = asyncio.run(scenario())
+    own = [at - start for at, method in sent if method.chat_id == 1]
+    other = [at - start for at, method in sent if method.chat_id == 2]
+    assert [method.text for _, method in sent if method.chat_id == 1] == [str(i) for i in range(7)]
+    # Первые chat_burst уходят сразу, дальше — не чаще chat_rate
+    assert own[2] < 0.03
+    gaps = [b - a for a, b in zip(own[2:], own[3:])]
+    assert all(gap >= 0.04 for gap in gaps)
+    assert own[-1] >= 4 * 0.05 * 0.9
+    # Соседний чат чужой лимит не ждёт
+    assert other[0] < 0.03
+
+
+def test_pending_edits_collapse_into_last():
+    async def scenario():
+        scheduler = make_scheduler(chat_rate=10, chat_burst=1)
+        api = FakeApi()
+        scheduler.start()
+        # Сообщение забирает единственный токен чата — правки встают в очередь
+        await scheduler(api, None, SendMessage(chat_id=1, text="черновик"))
+        results = await asyncio.gather(
+            *(scheduler(api, None, EditMessageText(chat_id=1, message_id=5, text=text)) for text in ("1", "12", "123"))
+        )
+        await scheduler.stop()
+        return results, [(type(method).__name__, method.text) for _, method in api.sent]
+
+    results, sent = asyncio.run(scenario())
+    assert sent == [("SendMessage", "черновик"), ("EditMessageText", "123")]
+    # Все вызывающие получают результат той правки, что реально ушла
+    assert results == ["123", "123", "123"]
+
+
+def test_retry_after_is_waited_and_retried():
+    async def scenario():
+        scheduler = make_scheduler()
+        api = FakeApi(failures={"hello": 0.2})
+        scheduler.start()
+        result = await scheduler(api, None, SendMessage(chat_id=1, text="hello"))
+        await scheduler.stop()
+        return result, [at for at, _ in api.sent]
+
+    result, sent = asyncio.run(scenario())
+    assert result == "hello"
+    assert len(sent) == 2
+    assert sent[1] - sent[0] >= 0.2 * 0.9
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def scenario():
+        scheduler = make_scheduler(max_retries=0)
+        api = FakeApi(failures={"hello": 0.05})
+        scheduler.start()
+        try:
+            await scheduler(api, None, SendMessage(chat_id=1, text="hello"))
+        except TelegramRetryAfter:
+            return "raised", len(api.sent)
+        finally:
+            await scheduler.stop()
+        return "sent", len(api.sent)
+
+    assert asyncio.run(scenario()) == ("raised", 1)
@@ -0,0 +1,47 @@
+import asyncio
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+from streaming import StreamingReply
+
+
+class FailingPlaceholder:
+    # Заглушка, у которой каждая правка падает с заданной ошибкой
+    def __init__(self, error):
+        self.error = error
+        self.edits = 0
+
+    async def edit_text(self, text, parse_mode=None):
+        self.edits += 1
+        raise self.error
+
+
+def run_stream(placeholder, chunks):
+    async def scenario():
+        reply = StreamingReply(placeholder, interval=0, min_delta=1, is_file=lambda text: False)
+        for chunk in chunks:
+            reply.feed(chunk)
+            await asyncio.sleep(0)
+        await reply.finish()
+        return reply.text
+
+    return asyncio.run(scenario())
+
+
+def test_network_error_on_preview_keeps_answer():
+    method = EditMessageText(chat_id=1, message_id=1, text="x")
+    placeholder = FailingPlaceholder(TelegramNetworkError(method=method, message="connection reset"))
+    assert run_stream(placeholder, ["Привет", ", ", "мир"]) == "Привет, мир"
+    # Поток правок после ошибки не умер
+    assert placeholder.edits > 1
+
+
+def test_unexpected_error_on_preview_keeps_answer():
+    assert run_stream(FailingPlaceholder(RuntimeError("boom")), ["a", "b"]) == "ab"
+
+
+def test_retry_after_on_preview_is_waited():
+    method = EditMessageText(chat_id=1, message_id=1, text="x")
+    placeholder = FailingPlaceholder(TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=0))
+    assert run_stream(placeholder, ["a", "b"]) == "ab"
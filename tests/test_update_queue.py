@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+
+import update_queue
+from update_queue import UpdateQueue
+
+
+def make_update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, event=SimpleNamespace(chat=SimpleNamespace(id=chat_id)))
+
+
+def make_queue(handler, workers=4, max_pending=100, max_per_chat=10, dedup_size=100):
+    return UpdateQueue(
+        handler, workers=workers, max_pending=max_pending, max_per_chat=max_per_chat, dedup_size=dedup_size
+    )
+
+
+def test_updates_of_one_chat_are_handled_in_order():
+    async def scenario():
+        seen = []
+
+        async def handler(update):
+            # Первый апдейт обрабатывается дольше остальных — порядок всё равно сохраняется
+            await asyncio.sleep(0.02 if update.update_id == 1 else 0)
+            seen.append(update.update_id)
+
+        queue = make_queue(handler)
+        queue.start()
+        for update_id in range(1, 6):
+            assert queue.put(make_update(update_id, chat_id=7)) == update_queue.ACCEPTED
+        await queue.stop()
+        return seen
+
+    assert asyncio.run(scenario()) == [1, 2, 3, 4, 5]
+
+
+def test_different_chats_are_handled_in_parallel():
+    async def scenario():
+        started = {1: asyncio.Event(), 2: asyncio.Event()}
+
+        async def handler(update):
+            chat_id = update.event.chat.id
+            started[chat_id].set()
+            # Каждый чат ждёт, пока начнётся обработка другого: без параллелизма — таймаут
+            await asyncio.wait_for(started[3 - chat_id].wait(), 1)
+
+        queue = make_queue(handler, workers=2)
+        queue.start()
+        queue.put(make_update(1, chat_id=1))
+        queue.put(make_update(2, chat_id=2))
+        await queue.stop()
+        return all(event.is_set() for event in started.values()), queue.pending
+
+    assert asyncio.run(scenario()) == (True, 0)
+
+
+def test_duplicate_update_id_is_handled_once():
+    async def scenario():
+        seen = []
+
+        async def handler(update):
+            seen.append(update.update_id)
+
+        queue = make_queue(handler)
+        queue.start()
+        assert queue.put(make_update(10, chat_id=1)) == update_queue.ACCEPTED
+        assert queue.put(make_update(10, chat_id=1)) == update_queue.DUPLICATE
+        await queue.stop()
+        assert queue.put(make_update(10, chat_id=1)) == update_queue.DUPLICATE
+        return seen
+
+    assert asyncio.run(scenario()) == [10]
+
+
+def test_chat_full_sheds_only_that_chat():
+    async def scenario():
+        async def handler(update):
+            pass
+
+        queue = make_queue(handler, max_per_chat=2)
+        results = [queue.put(make_update(update_id, chat_id=1)) for update_id in (1, 2, 3)]
+        other = queue.put(make_update(4, chat_id=2))
+        return results, other, queue.pending
+
+    results, other, pending = asyncio.run(scenario())
+    assert results == [update_queue.ACCEPTED, update_queue.ACCEPTED, update_queue.CHAT_FULL]
+    assert other == update_queue.ACCEPTED
+    assert pending == 3
+
+
+def test_saturated_queue_rejects_and_accepts_the_retry_later():
+    async def scenario():
+        seen = []
+
+        async def handler(update):
+            seen.append(update.update_id)
+
+        queue = make_queue(handler, max_pending=2)
+        results = [queue.put(make_update(update_id, chat_id=update_id)) for update_id in (1, 2, 3)]
+        queue.start()
+        await queue.stop()
+        # Отклонённый апдейт не запомнен как увиденный: повтор от Telegram будет принят
+        retry = queue.put(make_update(3, chat_id=3))
+        queue.start()
+        await queue.stop()
+        return results, retry, seen
+
+    results, retry, seen = asyncio.run(scenario())
+    assert results == [update_queue.ACCEPTED, update_queue.ACCEPTED, update_queue.SATURATED]
+    assert retry == update_queue.ACCEPTED
+    assert seen == [1, 2, 3]
@@ -0,0 +1,29 @@
+import logging
+
+_encoding = None
+_loaded = False
+
+
+def _get_encoding():
+    global _encoding, _loaded
+    if not _loaded:
+        _loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # Нет tiktoken или словаря — считаем приблизительно
+            logging.warning("tiktoken is unavailable, using approximate token counts")
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(role, content):
+    # ~4 служебных токена на сообщение в формате chat
+    return count_tokens(content) + 4
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+# Результат постановки апдейта в очередь
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+CHAT_FULL = "chat_full"
+SATURATED = "saturated"
+
+
+def chat_key(update):
+    # Апдейты одного чата обрабатываются строго по порядку, разных чатов — параллельно
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = getattr(event.message, "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    def __init__(self, handler, workers, max_pending, max_per_chat, dedup_size):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_chat = max_per_chat
+        self.dedup_size = dedup_size
+        self.pending = 0
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._seen = OrderedDict()
+        self._tasks = []
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self, timeout=10):
+        # Даём дообработать то, что уже принято, потом гасим воркеры
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Update queue stopped with %s pending updates", self.pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _drain(self):
+        while self.pending:
+            await asyncio.sleep(0.05)
+
+    def put(self, update):
+        if update.update_id in self._seen:
+            return DUPLICATE
+        if self.pending >= self.max_pending:
+            return SATURATED
+        key = chat_key(update)
+        queue = self._chats.get(key)
+        if queue is not None and len(queue) >= self.max_per_chat:
+            return CHAT_FULL
+
+        self._seen[update.update_id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+
+        self.pending += 1
+        if queue is None:
+            # Чат не занят — отдаём его воркерам; иначе апдейт дождётся своей очереди
+            self._chats[key] = deque([update])
+            self._ready.put_nowait(key)
+        else:
+            queue.append(update)
+        return ACCEPTED
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            update = queue[0]
+            try:
+                await self.handler(update)
+            except Exception:
+                logging.exception("Failed to process update %s", update.update_id)
+            finally:
+                queue.popleft()
+                self.pending -= 1
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
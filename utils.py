@@ -1,11 +1,11 @@
-from openai import AsyncOpenAI
+from ai_client import openai_client, model_slot
 
-async def generate_image(prompt, openai_api_key):
-    client = AsyncOpenAI(api_key=openai_api_key)
-    response = await client.images.generate(
-        model="dall-e-3",
-        prompt=prompt,
-        n=1,
-        size="1024x1024"
-    )
+async def generate_image(prompt):
+    async with model_slot("dall-e-3"):
+        response = await openai_client.images.generate(
+            model="dall-e-3",
+            prompt=prompt,
+            n=1,
+            size="1024x1024"
+        )
     return response.data[0].url
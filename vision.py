@@ -0,0 +1,126 @@
+import asyncio
+import base64
+import logging
+import re
+from io import BytesIO
+
+# Детализация для GPT-4o: low — одна плитка 512×512 за фиксированную цену,
+# high — картинка вписывается в 2048×2048, короткая сторона сжимается до 768 и режется на плитки 512
+LOW = "low"
+HIGH = "high"
+LOW_SIDE = 512
+HIGH_LONG_SIDE = 2048
+HIGH_SHORT_SIDE = 768
+
+# Вопросы, где важны мелкие детали: текст, цифры, схемы
+HIGH_DETAIL = re.compile(
+    r"текст|прочита|прочти|распозна|перепиш|перевед|мелк|детал|подробн|документ|чек|скрин|таблиц|"
+    r"формул|график|схем|диаграм|код|задач|цифр|надпис|read|text|ocr|detail|screenshot|table|code",
+    re.IGNORECASE,
+)
+
+DEFAULT_PROMPT = "Опиши, что на фото."
+
+
+def detail_for(caption):
+    return HIGH if caption and HIGH_DETAIL.search(caption) else LOW
+
+
+def target_size(width, height, detail):
+    # До этого размера модель всё равно сожмёт картинку — больше слать незачем
+    if detail == LOW:
+        scale = LOW_SIDE / max(width, height)
+    else:
+        scale = min(HIGH_LONG_SIDE / max(width, height), HIGH_SHORT_SIDE / min(width, height))
+    scale = min(1.0, scale)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def pick_size(sizes, detail):
+    # Telegram хранит фото в нескольких размерах: берём самый маленький, которого хватает
+    sizes = sorted(sizes, key=lambda s: s.width * s.height)
+    width, height = target_size(sizes[-1].width, sizes[-1].height, detail)
+    for size in sizes:
+        if size.width >= width and size.height >= height:
+            return size
+    return sizes[-1]
+
+
+def encode(data, detail, quality):
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(data)) as image:
+        target = target_size(image.width, image.height, detail)
+        if image.format == "JPEG" and image.width <= target[0] and image.height <= target[1]:
+            # Уже нужного размера — перекодирование только потеряет качество
+            return data
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail(target, Image.LANCZOS)
+        out = BytesIO()
+        image.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue()
+
+
+async def prepare(bot, sizes, detail, quality):
+    size = pick_size(sizes, detail)
+    file = await bot.get_file(size.file_id)
+    buffer = BytesIO()
+    await bot.download_file(file.file_path, destination=buffer)
+    data = await asyncio.to_thread(encode, buffer.getvalue(), detail, quality)
+    return "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+
+
+def content(prompt, urls, detail):
+    parts = [{"type": "text", "text": prompt}]
+    parts.extend({"type": "image_url", "image_url": {"url": url, "detail": detail}} for url in urls)
+    return parts
+
+
+class AlbumCollector:
+    # Фото альбома приходят отдельными апдейтами с общим media_group_id.
+    # Копим их, пока не наступит пауза window, и отдаём пачкой в фоне, не держа очередь чата.
+    def __init__(self, handler, window, max_items=10):
+        self.handler = handler
+        self.window = window
+        self.max_items = max_items
+        self._groups = {}
+        self._tasks = set()
+
+    def add(self, message):
+        key = (message.chat.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = [[], None]
+        else:
+            group[1].cancel()
+        group[0].append(message)
+        if len(group[0]) >= self.max_items:
+            self._flush(key)
+        else:
+            group[1] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key):
+        messages, timer = self._groups.pop(key)
+        if timer is not None:
+            timer.cancel()
+        messages.sort(key=lambda m: m.message_id)
+        task = asyncio.create_task(self._run(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, messages):
+        try:
+            await self.handler(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Album processing failed for chat %s", messages[0].chat.id)
+
+    async def stop(self, timeout=30):
+        for key in list(self._groups):
+            self._flush(key)
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
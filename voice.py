@@ -0,0 +1,77 @@
+import asyncio
+from io import BytesIO
+
+from openai import BadRequestError
+
+from ai_client import openai_client, model_slot
+
+
+async def download(bot, file_path):
+    buffer = BytesIO()
+    await bot.download_file(file_path, destination=buffer)
+    return buffer.getvalue()
+
+
+async def _whisper(data, filename):
+    async with model_slot("whisper-1"):
+        transcript = await openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(filename, data),
+            response_format="text",
+            language="ru"
+        )
+    return transcript.text if hasattr(transcript, "text") else str(transcript)
+
+
+def _transcode(data, fmt):
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(BytesIO(data), format=fmt)
+    out = BytesIO()
+    audio.export(out, format="mp3", bitrate="48k")
+    return out.getvalue()
+
+
+def _split_on_silence(data, fmt, chunk_seconds):
+    # Режем рядом с целевой длиной куска, но по ближайшей паузе, чтобы не рвать слова
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+    audio = AudioSegment.from_file(BytesIO(data), format=fmt)
+    target = chunk_seconds * 1000
+    silences = detect_silence(audio, min_silence_len=400, silence_thresh=audio.dBFS - 16, seek_step=10)
+    pauses = [(start + end) // 2 for start, end in silences]
+    cuts = []
+    position = 0
+    while len(audio) - position > target:
+        window = [p for p in pauses if position + target // 2 < p <= position + target]
+        cut = window[-1] if window else position + target
+        cuts.append(cut)
+        position = cut
+    chunks = []
+    start = 0
+    for cut in cuts + [len(audio)]:
+        out = BytesIO()
+        audio[start:cut].export(out, format="ogg", codec="libopus", bitrate="32k")
+        chunks.append(out.getvalue())
+        start = cut
+    return chunks
+
+
+async def transcribe(data, duration, chunk_seconds, max_parallel, fmt="ogg"):
+    # Голосовые Telegram — OGG/Opus, Whisper принимает его как есть
+    if duration <= chunk_seconds:
+        try:
+            return await _whisper(data, f"voice.{fmt}")
+        except BadRequestError:
+            # Формат не принят — перекодируем вне event loop и пробуем ещё раз
+            data = await asyncio.to_thread(_transcode, data, fmt)
+            return await _whisper(data, "voice.mp3")
+
+    chunks = await asyncio.to_thread(_split_on_silence, data, fmt, chunk_seconds)
+    slots = asyncio.Semaphore(max_parallel)
+
+    async def run(chunk):
+        async with slots:
+            return await _whisper(chunk, "voice.ogg")
+
+    parts = await asyncio.gather(*[run(chunk) for chunk in chunks])
+    return " ".join(part.strip() for part in parts if part.strip())